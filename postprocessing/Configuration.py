@@ -8,8 +8,12 @@
 """
 import sys
 import os
+import re
 import json
+import time
 import logging
+import profiling
+import latency
 
 class StreamToLogger(object):
     """
@@ -72,6 +76,10 @@ class Configuration(object):
         self.service_status = config['service_status'] if 'service_status' in config else "/topic/SNS.${instrument}.STATUS.POSTPROCESS"
 
         self.heart_beat = config['heart_beat']
+        # If True, status messages are sent together when a task is done
+        self.amq_batch_send = config['amq_batch_send']==1 if 'amq_batch_send' in config else False
+        # Idle time after which the connection used to send status messages is opened again, in seconds
+        self.amq_idle_timeout = config['amq_idle_timeout'] if 'amq_idle_timeout' in config else 60.0
         self.log_file = config['log_file'] if 'log_file' in config else 'post_processing.log'
         self.start_script = config['start_script'] if 'start_script' in config else 'startJob.sh'
         self.task_script = config['task_script'] if 'task_script' in config else 'PostProcessAdmin.py'
@@ -83,12 +91,22 @@ class Configuration(object):
 
         self.max_nodes = config['max_nodes'] if 'max_nodes' in config else 32
         self.max_memory = config['max_memory'] if 'max_memory' in config else 8.0
+        self.node_sizing_cache = config['node_sizing_cache'] if 'node_sizing_cache' in config else os.path.join(self.sw_dir, 'log', 'node_sizing_cache.json')
         self.max_procs = config['max_procs'] if 'max_procs' in config else 5
+        self.prefetch_size = config['prefetch_size'] if 'prefetch_size' in config else 1
         self.processors_per_node = config['processors_per_node'] if 'processors_per_node' in config else 16
+        self.max_parallel_jobs = config['max_parallel_jobs'] if 'max_parallel_jobs' in config else 1
         self.wait_notification_period = config['wait_notification_period'] if 'wait_notification_period' in config else 900
+        # Batch system job monitoring
+        self.qstat_command = config['qstat_command'] if 'qstat_command' in config else 'qstat'
+        self.job_poll_interval_min = config['job_poll_interval_min'] if 'job_poll_interval_min' in config else 2.0
+        self.job_poll_interval_max = config['job_poll_interval_max'] if 'job_poll_interval_max' in config else 30.0
 
         self.web_monitor_url = config['webmon_url_template'] if 'webmon_url_template' in config else "https://monitor.sns.gov/files/$instrument/$run_number/submit_reduced/"
         self.max_image_size = config['max_image_size'] if 'max_image_size' in config else 500000
+        self.web_monitor_threads = config['webmon_upload_threads'] if 'webmon_upload_threads' in config else 4
+        self.web_monitor_retries = config['webmon_upload_retries'] if 'webmon_upload_retries' in config else 3
+        self.web_monitor_timeout = config['webmon_upload_timeout'] if 'webmon_upload_timeout' in config else 60
         self.comm_only = config['communication_only']==1 if 'communication_only' in config else False
         self.remote_execution = config['remote_execution']==1 if 'remote_execution' in config else False
 
@@ -96,29 +114,59 @@ class Configuration(object):
         self.task_script_data_arg = config['task_script_data_arg'] if 'task_script_data_arg' in config else None
 
         self.exceptions = config['exceptions'] if 'exceptions' in config else ["Error in logging framework"]
+        # Patterns for errors to ignore, combined and compiled once
+        self.exceptions_re = None
+        if len(self.exceptions) > 0:
+            self.exceptions_re = re.compile('|'.join(['(?:%s)' % item for item in self.exceptions]))
+
+        # Following of local job logs
+        self.log_follow_interval = config['log_follow_interval'] if 'log_follow_interval' in config else 1.0
+        self.progress_interval = config['progress_interval'] if 'progress_interval' in config else 30.0
+        self.kill_on_error = config['kill_on_error']==1 if 'kill_on_error' in config else False
 
         self.jobs_per_instrument = config['jobs_per_instrument'] if 'jobs_per_instrument' in config else 2
 
+        # Pool of long-lived workers
+        self.worker_pool = config['worker_pool']==1 if 'worker_pool' in config else False
+        self.worker_script = config['worker_script'] if 'worker_script' in config else 'worker.py'
+        self.worker_max_tasks = config['worker_max_tasks'] if 'worker_max_tasks' in config else 100
+        self.worker_max_memory = config['worker_max_memory'] if 'worker_max_memory' in config else 2048
+        # Workers run in the same environment as the task script. startJob.sh only takes
+        # the arguments of a task, so its companion startWorker.sh is used to start workers.
+        if 'worker_start_script' in config:
+            self.worker_start_script = config['worker_start_script']
+        elif os.path.basename(self.start_script) == 'startJob.sh':
+            self.worker_start_script = os.path.join(os.path.dirname(self.start_script), 'startWorker.sh')
+        else:
+            self.worker_start_script = self.start_script
+
+        # Start-up profiling, which can also be turned on with the POSTPROCESSING_PROFILE environment variable
+        self.profile = config['profile']==1 if 'profile' in config else False
+        # End-to-end latency records, turned off if empty
+        self.latency_file = config['latency_file'] if 'latency_file' in config else ''
+
+        # ICAT write-behind: new datasets are created in batches
+        self.icat_write_behind = config['icat_write_behind']==1 if 'icat_write_behind' in config else False
+        self.icat_batch_size = config['icat_batch_size'] if 'icat_batch_size' in config else 20
+        self.icat_batch_delay = config['icat_batch_delay'] if 'icat_batch_delay' in config else 10.0
+
         # plot publishing
         self.publish_url = config['publish_url_template'] if 'publish_url_template' in config else ''
         self.publisher_username = config['publisher_username'] if 'publisher_username' in config else ''
         self.publisher_password = config['publisher_password'] if 'publisher_password' in config else ''
 
         sys.path.insert(0, self.sw_dir)
-        # Configure processor plugins
+        # Configure processor plugins, mapping each input queue to its processors
         self.processors = config['processors'] if 'processors' in config else []
-        if isinstance(self.processors, list):
-            for p in self.processors:
-                toks = p.split('.')
-                if len(toks) == 2:
-                    processor_module = __import__("postprocessing.processors.%s" % toks[0], globals(), locals(), [toks[1],], -1)
-                    try:
-                        processor_class = eval("processor_module.%s" % toks[1])
-                        self.queues.append(processor_class.get_input_queue_name())
-                    except:
-                        logging.error("Configuration: Error loading processor: %s", sys.exc_value)
-                else:
-                    logging.error("Configuration: Processors can only be specified in the format module.Processor_class")
+        self.processor_registry = {}
+        try:
+            from postprocessing.processors import build_registry
+            self.processor_registry = build_registry(self.processors)
+        except:
+            logging.error("Configuration: Error loading processors: %s", sys.exc_value)
+        for queue in self.processor_registry:
+            if queue not in self.queues:
+                self.queues.append(queue)
 
     def log_configuration(self):
         """
@@ -134,6 +182,8 @@ class Configuration(object):
         else:
             logging.info("  - LOCAL execution")
         logging.info("  - Max number of processes: %s", self.max_procs)
+        if self.worker_pool:
+            logging.info("  - Worker pool: recycle after %s tasks or %s MB", self.worker_max_tasks, self.worker_max_memory)
         logging.info("  - Input queues: %s", self.queues)
         logging.info("  - Installation dir: %s", self.sw_dir)
         logging.info("  - Start script: %s", self.start_script)
@@ -149,6 +199,30 @@ stomp_logger.setLevel(logging.ERROR)
 CONFIG_FILE = '/etc/autoreduce/post_processing.conf'
 CONFIG_FILE_ALTERNATE = '/sw/fermi/autoreduce/postprocessing/configuration/post_processing.conf'
 
+# Configurations already read, by file name, with the time stamp of the file
+_configurations = {}
+
+def get_configuration(config_file=CONFIG_FILE):
+    """
+        Returns the configuration object for a given configuration file.
+        The file is only processed again if it was modified since
+        it was last read. The returned object is shared and should
+        not be modified.
+        @param config_file: configuration file to process
+    """
+    config_file = os.path.abspath(config_file)
+    try:
+        stat_info = os.stat(config_file)
+        time_stamp = (stat_info.st_mtime, stat_info.st_size)
+    except OSError:
+        raise RuntimeError("Configuration file doesn't exist or is not readable: %s" % config_file)
+    cached = _configurations.get(config_file)
+    if cached is not None and cached[0] == time_stamp:
+        return cached[1]
+    configuration = Configuration(config_file)
+    _configurations[config_file] = (time_stamp, configuration)
+    return configuration
+
 def read_configuration(config_file=None):
     """
         Returns a new configuration object for a given
@@ -163,7 +237,9 @@ def read_configuration(config_file=None):
             if os.access(config_file, os.R_OK) == False:
                 raise RuntimeError("Configuration file doesn't exist or is not readable: %s" % CONFIG_FILE)
 
+    t_0 = time.time()
     configuration = Configuration(config_file)
+    profiling.record('config', time.time() - t_0, file=config_file)
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s %(levelname)s/%(process)d %(message)s",
@@ -179,4 +255,6 @@ def read_configuration(config_file=None):
     sl = StreamToLogger(stderr_logger, logging.ERROR)
     sys.stderr = sl
 
+    profiling.configure(configuration)
+    latency.configure(configuration)
     return configuration
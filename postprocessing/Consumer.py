@@ -5,14 +5,43 @@
     
     @copyright: 2014 Oak Ridge National Laboratory
 """
-import json, logging, time, subprocess, sys, socket
+import json, logging, sys, socket, time
 import os
+import collections
+import profiling
+import latency
 
-from twisted.internet import reactor, defer
-from stompest import async, sync
+from twisted.internet import reactor, defer, protocol
+from stompest import async
 from stompest.config import StompConfig
 from stompest.async.listener import SubscriptionListener
 from stompest.protocol import StompSpec, StompFailoverUri
+from worker_pool import WorkerPool, find_executable
+from process_registry import ProcessRegistry
+
+## Message waiting for a free slot
+PendingMessage = collections.namedtuple('PendingMessage', ['client', 'frame', 'destination', 'data',
+                                                           'data_dict', 'instrument', 'received'])
+
+
+class ProcessMonitor(protocol.ProcessProtocol):
+    """
+        Keeps track of a post-processing process started by the consumer
+    """
+    def __init__(self, callback):
+        """
+            @param callback: function called with this object when the process ends
+        """
+        self.pid = None
+        self.returncode = None
+        self._callback = callback
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+
+    def processEnded(self, reason):
+        self.returncode = reason.value.exitCode
+        self._callback(self)
 
 
 class Consumer(object):
@@ -22,21 +51,34 @@ class Consumer(object):
     def __init__(self, config):
         self.stompConfig = StompConfig(config.failover_uri, config.amq_user, config.amq_pwd, version=StompSpec.VERSION_1_1)
         self.config = config
-        self.procList = []
-        self.instrument_jobs = {}
-        
+        self.processes = ProcessRegistry()
+        # Messages waiting for a free slot, not yet acknowledged
+        self.pending = collections.deque()
+        # Time spent waiting for a slot by messages started since the last heartbeat
+        self.queue_waits = []
+        # Open connection to the broker, used to send heartbeats
+        self.client = None
+        self.worker_pool = None
+        self._first_message = True
+        if config.worker_pool:
+            self.worker_pool = WorkerPool(config)
+            self.worker_pool.start()
+
     @defer.inlineCallbacks
     def run(self):
         """
             Run method to start listening
         """
+        t_0 = time.time()
         client = yield async.Stomp(self.stompConfig).connect()
+        profiling.record('connect', time.time() - t_0, name='amq')
+        self.client = client
         headers = {
             # client-individual mode is necessary for concurrent processing
             # (requires ActiveMQ >= 5.2)
             StompSpec.ACK_HEADER: StompSpec.ACK_CLIENT_INDIVIDUAL,
             # the maximal number of messages the broker will let you work on at the same time
-            'activemq.prefetchSize': '1',
+            'activemq.prefetchSize': str(self.config.prefetch_size),
         }
         if self.config.heartbeat_ping not in self.config.queues:
             self.config.queues.append(self.config.heartbeat_ping)
@@ -45,10 +87,14 @@ class Consumer(object):
             client.subscribe(q, headers, listener=SubscriptionListener(self.consume, 
                                                                        ack=False,
                                                                        errorDestination=self.config.postprocess_error))
+        connection = client
         try:
             client = yield client.disconnected
         except:
             logging.error("Connection error: %s" % sys.exc_value)
+        self.client = None
+        # Messages we were holding on to will be redelivered by the broker
+        self.pending = collections.deque([item for item in self.pending if item.client is not connection])
         reactor.callLater(5, self.run)
         
     def consume(self, client, frame):
@@ -88,99 +134,173 @@ class Consumer(object):
                 client.ack(frame)
                 return
             logging.info("Received %s: %s" % (destination, data))
+            latency.mark(data_dict, 'received')
+            if self._first_message:
+                self._first_message = False
+                profiling.record('first_message', destination=destination)
             instrument = None
             if self.config.jobs_per_instrument>0 and "instrument" in data_dict:
                 instrument = data_dict["instrument"].upper()
-                if instrument in self.instrument_jobs:
-                    self.update_processes()
-                    if len(self.instrument_jobs[instrument])>=self.config.jobs_per_instrument:
-                        client.nack(frame)
-                        logging.error("Too many jobs for %s on %s: rejecting" % (instrument, os.getpid()))
-                        return
-                else:
-                    self.instrument_jobs[instrument] = []
-            client.ack(frame)
+                if self.reject_instrument(client, frame, instrument):
+                    return
+
+            # If all the slots are taken, hold on to the message without acknowledging it.
+            # The broker will not deliver more than the prefetch size of unacknowledged
+            # messages, so this is how we apply back-pressure without blocking the reactor.
+            # As before, up to max_procs+1 processes may run at once.
+            if len(self.processes) > self.config.max_procs:
+                self.pending.append(PendingMessage(client, frame, destination, data,
+                                                   data_dict, instrument, time.time()))
+                logging.info("Maxmimum number of sub-processes reached: %s [%s waiting]" % (len(self.processes), len(self.pending)))
+                return
         except:
             logging.error(sys.exc_value)
             # Raising an exception here may result in an ActiveMQ result being sent.
             # We therefore pick a message that will mean someone to the users.
             raise RuntimeError, "Error processing incoming message: contact post-processing expert"
 
+        self.start_process(client, frame, destination, data, data_dict, instrument)
+
+    def reject_instrument(self, client, frame, instrument):
+        """
+            Reject a message if too many jobs are running for its instrument.
+            Returns True if the message was rejected.
+            @param client: Stomp connection object
+            @param frame: StompFrame object
+            @param instrument: instrument name
+        """
+        if self.processes.instrument_count(instrument)>=self.config.jobs_per_instrument:
+            client.nack(frame)
+            logging.error("Too many jobs for %s on %s: rejecting" % (instrument, os.getpid()))
+            return True
+        return False
+
+    def start_process(self, client, frame, destination, data, data_dict, instrument):
+        """
+            Acknowledge a message and start processing it
+            @param client: Stomp connection object
+            @param frame: StompFrame object
+            @param destination: queue the message was received on
+            @param data: message body
+            @param data_dict: decoded message body
+            @param instrument: instrument name, or None if we don't limit jobs per instrument
+        """
         try:
-            # Put together the command to execute, including any optional arguments
-            post_proc_script = os.path.join(self.config.python_dir, self.config.task_script)
-            command_args = [self.config.start_script, post_proc_script]
-            
-            # Format the queue name argument
-            if self.config.task_script_queue_arg is not None:
-                command_args.append(self.config.task_script_queue_arg)
-            command_args.append(destination)
-            
-            # Format the data argument
-            if self.config.task_script_data_arg is not None:
-                command_args.append(self.config.task_script_data_arg)
-            command_args.append(str(data).replace(' ',''))
-            
-            logging.debug("Command: %s" % str(command_args))
-            proc = subprocess.Popen(command_args)
-            self.procList.append(proc)
-            if instrument is not None:
-                self.instrument_jobs[instrument].append(proc)
-            
-            # Check whether the maximum number of processes has been reached
-            max_procs_reached = len(self.procList) > self.config.max_procs
-            if max_procs_reached:
-                logging.info("Maxmimum number of sub-processes reached: %s" % len(self.procList))
-                
-            # If we have reached the max number of processes, block until we have
-            # at least on free slot
-            while len(self.procList) > self.config.max_procs:
-                time.sleep(1.0)
-                self.update_processes()
-                
-            if max_procs_reached:
-                logging.info("Resuming. Number of sub-processes: %s" % len(self.procList))
-            self.update_processes()
+            client.ack(frame)
+            latency.mark(data_dict, 'admitted')
+            if latency.is_enabled():
+                # Pass the stage markers along with the message
+                latency.mark(data_dict, 'spawned')
+                data = json.dumps(data_dict)
+            if self.worker_pool is not None:
+                proc = self.worker_pool.submit(destination, data_dict, callback=self.process_ended)
+            else:
+                proc = self.spawn_process(destination, data)
+            self.processes.add(proc, destination, instrument)
         except:
             logging.error(sys.exc_value)
             # Raising an exception here may result in an ActiveMQ result being sent.
             # We therefore pick a message that will mean someone to the users.
             raise RuntimeError, "Error processing message: contact post-processing expert"
+
+    def spawn_process(self, destination, data):
+        """
+            Start a new post-processing process for a message
+            @param destination: queue the message was received on
+            @param data: message body
+        """
+        # Put together the command to execute, including any optional arguments
+        post_proc_script = os.path.join(self.config.python_dir, self.config.task_script)
+        command_args = [find_executable(self.config.start_script), post_proc_script]
+        
+        # Format the queue name argument
+        if self.config.task_script_queue_arg is not None:
+            command_args.append(self.config.task_script_queue_arg)
+        command_args.append(destination)
         
-    def update_processes(self):
+        # Format the data argument
+        if self.config.task_script_data_arg is not None:
+            command_args.append(self.config.task_script_data_arg)
+        command_args.append(str(data).replace(' ',''))
+        
+        logging.debug("Command: %s" % str(command_args))
+        proc = ProcessMonitor(self.process_ended)
+        reactor.spawnProcess(proc, command_args[0], command_args,
+                             env=os.environ, childFDs={0: 0, 1: 1, 2: 2})
+        return proc
+
+    def process_ended(self, proc):
+        """
+            Called by the reactor when a process finishes.
+            The free slot is given to the next message waiting for one.
+            @param proc: ProcessMonitor or WorkerTask object that finished
         """
-            Go through finished processed and process any log that came
-            out of them.
+        self.processes.process_ended(proc)
+        self.processes.reap()
+        self.fill_slots()
+
+    def fill_slots(self):
+        """
+            Start processing messages that were waiting for a free slot
         """
-        for i in self.procList:
-            if i.poll() is not None:
-                for instrument in self.instrument_jobs:
-                    if i in self.instrument_jobs[instrument]:
-                        self.instrument_jobs[instrument].remove(i)
-                self.procList.remove(i)
-                
-    def heartbeat(self, destination=None, data_dict={}):
+        while len(self.pending) > 0 and len(self.processes) <= self.config.max_procs:
+            item = self.pending.popleft()
+            try:
+                if item.instrument is not None and self.reject_instrument(item.client, item.frame, item.instrument):
+                    continue
+                self.start_process(item.client, item.frame, item.destination,
+                                   item.data, item.data_dict, item.instrument)
+                self.queue_waits.append(time.time() - item.received)
+                logging.info("Resuming. Number of sub-processes: %s [%s waiting]" % (len(self.processes), len(self.pending)))
+            except:
+                logging.error("Could not process waiting message: %s" % sys.exc_value)
+
+    def heartbeat(self, destination=None, data_dict=None):
         """
-            Send heartbeats at a regular time interval
+            Send heartbeats at a regular time interval.
+            The heartbeat is sent over the connection we listen on,
+            and includes the current load of the agent.
             @param: destination where to send the heartbeat 
             @param data_dict: optional dictionary to pass along
         """
         try:
             if destination is None:
                 destination = self.config.heart_beat
-            stomp = sync.Stomp(self.stompConfig)
-            stomp.connect()
-            if not type(data_dict) == dict:
+            if self.client is None:
+                logging.warning("Could not send heartbeat: not connected")
+                return
+            if data_dict is None:
+                data_dict = {}
+            elif not type(data_dict) == dict:
                 logging.error("Heartbeat argument data_dict was not a dict")
                 data_dict = {}
             data_dict.update({"src_name": socket.gethostname(), 
                               "role": "postprocessing",
                               "status": "0", "pid": str(os.getpid())})
-            stomp.send(destination, json.dumps(data_dict))
-            stomp.disconnect()
+            # Only regular heartbeats start a new reporting period
+            data_dict.update(self.load_status(reset=destination == self.config.heart_beat))
+            self.client.send(destination, json.dumps(data_dict))
         except:
             logging.error("Could not send heartbeat: %s" % sys.exc_value)
 
+    def load_status(self, reset=True):
+        """
+            Returns a dictionary describing the current load of the agent
+            @param reset: if True, start a new period for the queue wait statistics
+        """
+        now = time.time()
+        waiting = [now - item.received for item in self.pending]
+        status = {"processes": len(self.processes),
+                  "max_procs": self.config.max_procs,
+                  "instrument_jobs": dict(self.processes.instrument_counts),
+                  "waiting": len(waiting),
+                  "max_wait_time": max(waiting) if len(waiting) > 0 else 0,
+                  "avg_queue_wait": sum(self.queue_waits) / len(self.queue_waits) if len(self.queue_waits) > 0 else 0,
+                  "max_queue_wait": max(self.queue_waits) if len(self.queue_waits) > 0 else 0}
+        if reset:
+            self.queue_waits = []
+        return status
+
     def ack_ping(self, data):
         """
             Send an ACK message in response to a ping
@@ -10,12 +10,16 @@
 
     @copyright: 2014 Oak Ridge National Laboratory
 """
-import logging, json, socket, os, sys, subprocess, time, glob, requests
+import logging, json, socket, os, sys, subprocess, time
 import re
 import string
+# Imported first so that the import of the dependencies can be timed
+import profiling
+import latency
 import processors.job_handling as job_handling
-from stompest.config import StompConfig
-from stompest.sync import Stomp
+from amq_producer import get_producer, close_producer
+from icat_client import get_dataset_batch, close_session_pool
+from file_index import find_reduced_files
 
 class PostProcessAdmin:
     def __init__(self, data, conf):
@@ -23,14 +27,14 @@ class PostProcessAdmin:
         if not type(data) == dict:
             raise ValueError, "PostProcessAdmin expects a data dictionary"
         data["information"] = socket.gethostname()
+        latency.mark(data, 'started')
         self.data = data
         self.conf = conf
 
         # List of error messages to be handled as information
         self.exceptions = self.conf.exceptions
 
-        stompConfig = StompConfig(self.conf.failover_uri, self.conf.amq_user, self.conf.amq_pwd)
-        self.client = Stomp(stompConfig)
+        self.producer = get_producer(self.conf)
 
         self.data_file = None
         self.facility = None
@@ -108,6 +112,7 @@ class PostProcessAdmin:
             # Run the reduction
             out_log = os.path.join(log_dir, os.path.basename(self.data_file) + ".log")
             out_err = os.path.join(log_dir, os.path.basename(self.data_file) + ".err")
+            latency.mark(self.data, 'job_submitted')
             if remote:
                 job_handling.remote_submission(self.conf, reduce_script_path,
                                                self.data_file, proposal_shared_dir,
@@ -115,7 +120,9 @@ class PostProcessAdmin:
             else:
                 job_handling.local_submission(self.conf, reduce_script_path,
                                               self.data_file, proposal_shared_dir,
-                                              out_log, out_err)
+                                              out_log, out_err,
+                                              status_callback=job_handling.status_sender(self.conf, self.data, self.send))
+            latency.mark(self.data, 'job_finished')
 
             # Determine error condition
             success, status_data = job_handling.determine_success_local(self.conf, out_err)
@@ -140,13 +147,30 @@ class PostProcessAdmin:
             from ingest_nexus import IngestNexus
             self.send('/queue/' + self.conf.catalog_started, json.dumps(self.data))
             if self.conf.comm_only is False:
-                ingestNexus = IngestNexus(self.data_file)
-                ingestNexus.execute()
-                ingestNexus.logout()
-                self.send('/queue/' + self.conf.catalog_complete, json.dumps(self.data))
+                batch = None
+                if self.conf.icat_write_behind:
+                    batch = get_dataset_batch(self.conf.icat_batch_size, self.conf.icat_batch_delay)
+                ingestNexus = IngestNexus(self.data_file, batch=batch)
+                try:
+                    queued = ingestNexus.execute(callback=self._catalog_raw_done)
+                finally:
+                    ingestNexus.logout()
+                # In write-behind mode, the status is sent once the dataset is created
+                if not queued:
+                    self._catalog_raw_done()
         except:
-            logging.error("catalog_raw: %s" % sys.exc_value)
-            self.data["error"] = "Catalog: %s" % sys.exc_value
+            self._catalog_raw_done(str(sys.exc_value))
+
+    def _catalog_raw_done(self, error=None):
+        """
+            Send the result of the cataloging of a raw data file
+            @param error: error message, or None if the file was cataloged
+        """
+        if error is None:
+            self.send('/queue/' + self.conf.catalog_complete, json.dumps(self.data))
+        else:
+            logging.error("catalog_raw: %s" % error)
+            self.data["error"] = "Catalog: %s" % error
             self.send('/queue/' + self.conf.catalog_error, json.dumps(self.data))
 
     def catalog_reduced(self):
@@ -159,32 +183,35 @@ class PostProcessAdmin:
             self.send('/queue/' + self.conf.reduction_catalog_started, json.dumps(self.data))
 
             if self.conf.comm_only is False:
-                # Send image to the web monitor
+                # Find the reduced files once, for both the web monitor and the catalog
+                proposal_dir = os.path.join('/', self.facility, self.instrument, self.proposal)
+                reduced_files = find_reduced_files(proposal_dir, self.instrument, self.run_number)
+
+                # Send images to the web monitor while the files are being cataloged
+                uploader = None
                 if len(self.conf.web_monitor_url.strip()) > 0:
+                    from web_monitor import WebMonitorUploader
                     monitor_user = {'username': self.conf.amq_user, 'password': self.conf.amq_pwd}
-                    proposal_shared_dir = os.path.join('/', self.facility, self.instrument, self.proposal, 'shared', 'autoreduce')
 
                     url_template = string.Template(self.conf.web_monitor_url)
                     url = url_template.substitute(instrument=self.instrument, run_number=self.run_number)
 
-                    pattern = self.instrument + "_" + self.run_number + "*"
-                    for dirpath, dirnames, filenames in os.walk(proposal_shared_dir):
-                        listing = glob.glob(os.path.join(dirpath, pattern))
-                        for filepath in listing:
-                            f, e = os.path.splitext(filepath)
-                            if e.startswith(os.extsep):
-                                e = e[len(os.extsep):]
-                                if e == "png" or e == "jpg" or filepath.endswith("plot_data.dat") or filepath.endswith("plot_data.json"):
-                                    files = {'file': open(filepath, 'rb')}
-                                    # Post the file if it's small enough
-                                    if len(files) != 0 and os.path.getsize(filepath) < self.conf.max_image_size:
-                                        request = requests.post(url, data=monitor_user, files=files, verify=False)
-                                        logging.info("Submitted %s [status: %s]" % (filepath,
-                                                                                    request.status_code))
-
-                ingestReduced = IngestReduced(self.facility, self.instrument, self.proposal, self.run_number)
-                ingestReduced.execute()
-                ingestReduced.logout()
+                    uploader = WebMonitorUploader(url, monitor_user, self.conf.max_image_size,
+                                                  threads=self.conf.web_monitor_threads,
+                                                  retries=self.conf.web_monitor_retries,
+                                                  timeout=self.conf.web_monitor_timeout)
+                    uploader.start(reduced_files)
+
+                try:
+                    ingestReduced = IngestReduced(self.facility, self.instrument, self.proposal, self.run_number,
+                                                  files=reduced_files)
+                    try:
+                        ingestReduced.execute()
+                    finally:
+                        ingestReduced.logout()
+                finally:
+                    if uploader is not None:
+                        uploader.wait()
             self.send('/queue/' + self.conf.reduction_catalog_complete , json.dumps(self.data))
         except:
             logging.error("catalog_reduced: %s" % sys.exc_value)
@@ -211,9 +238,50 @@ class PostProcessAdmin:
             @param data: payload of the message
         """
         logging.info("%s: %s" % (destination, data))
-        self.client.connect()
-        self.client.send(destination, data)
-        self.client.disconnect()
+        self.producer.send(destination, data)
+
+def process_message(queue, data, configuration):
+    """
+        Process an incoming message by calling the task registered
+        for the queue it came from.
+        @param queue: ActiveMQ queue the message was received on
+        @param data: data dictionary
+        @param configuration: configuration object
+    """
+    try:
+        pp = PostProcessAdmin(data, configuration)
+        if isinstance(configuration.reduction_data_ready, list) and \
+            queue in ['/queue/%s' % q for q in configuration.reduction_data_ready]:
+            pp.reduce(configuration.remote_execution)
+        elif queue == '/queue/%s' % configuration.reduction_data_ready:
+            pp.reduce(configuration.remote_execution)
+        elif queue == '/queue/%s' % configuration.catalog_data_ready:
+            pp.catalog_raw()
+        elif queue == '/queue/%s' % configuration.reduction_catalog_data_ready:
+            pp.catalog_reduced()
+        elif queue == '/queue/%s' % configuration.create_reduction_script:
+            pp.create_reduction_script()
+
+        # Call the processors registered for this queue
+        for name in configuration.processor_registry.get(queue, []):
+            try:
+                from postprocessing.processors import load_processor
+                with profiling.timer('import', name=name):
+                    processor_class = load_processor(name)
+                # Instantiate and call the processor
+                proc = processor_class(data, configuration, send_function=pp.send)
+                proc()
+            except:
+                logging.error("PostProcessAdmin: Processor error: %s" % sys.exc_value)
+
+    except:
+        # If we have a proper data dictionary, send it back with an error message
+        if type(data) == dict:
+            data["error"] = str(sys.exc_value)
+            get_producer(configuration).send(configuration.postprocess_error, json.dumps(data))
+        raise
+    finally:
+        latency.write_record(queue, data)
 
 if __name__ == "__main__":
     import argparse
@@ -254,46 +322,12 @@ if __name__ == "__main__":
         else:
             data = json.loads(namespace.data)
 
-        # Process the data
+        profiling.record('first_message', destination=namespace.queue)
         try:
-            pp = PostProcessAdmin(data, configuration)
-            if isinstance(configuration.reduction_data_ready, list) and \
-                namespace.queue in ['/queue/%s' % q for q in configuration.reduction_data_ready]:
-                pp.reduce(configuration.remote_execution)
-            elif namespace.queue == '/queue/%s' % configuration.reduction_data_ready:
-                pp.reduce(configuration.remote_execution)
-            elif namespace.queue == '/queue/%s' % configuration.catalog_data_ready:
-                pp.catalog_raw()
-            elif namespace.queue == '/queue/%s' % configuration.reduction_catalog_data_ready:
-                pp.catalog_reduced()
-            elif namespace.queue == '/queue/%s' % configuration.create_reduction_script:
-                pp.create_reduction_script()
-
-            # Check for registered processors
-            if type(configuration.processors) == list:
-                for p in configuration.processors:
-                    toks = p.split('.')
-                    if len(toks) == 2:
-                        processor_module = __import__("postprocessing.processors.%s" % toks[0], globals(), locals(), [toks[1], ], -1)
-                        try:
-                            processor_class = eval("processor_module.%s" % toks[1])
-                            if namespace.queue == processor_class.get_input_queue_name():
-                                # Instantiate and call the processor
-                                proc = processor_class(data, configuration, send_function=pp.send)
-                                proc()
-                        except:
-                            logging.error("PostProcessAdmin: Processor error: %s" % sys.exc_value)
-                    else:
-                        logging.error("PostProcessAdmin: Processors can only be specified in the format module.Processor_class")
-
-        except:
-            # If we have a proper data dictionary, send it back with an error message
-            if type(data) == dict:
-                data["error"] = str(sys.exc_value)
-                stomp = Stomp(StompConfig(configuration.failover_uri, configuration.amq_user, configuration.amq_pwd))
-                stomp.connect()
-                stomp.send(configuration.postprocess_error, json.dumps(data))
-                stomp.disconnect()
-            raise
+            process_message(namespace.queue, data, configuration)
+        finally:
+            close_session_pool()
+            close_producer()
+            profiling.record('done')
     except:
         logging.error("PostProcessAdmin: %s" % sys.exc_value)
@@ -0,0 +1,150 @@
+"""
+    ActiveMQ producer that keeps its connection open between messages.
+
+    The connection is only opened when the first message is sent, and
+    re-opened if sending fails. A connection that has been idle for a
+    while is closed and opened again before sending, since a broker or
+    firewall may have dropped it without us noticing: a send over such
+    a connection can succeed locally while the message is lost.
+
+    In batch mode, messages are kept in memory and sent together when
+    flush() or close() is called.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import logging
+import threading
+import profiling
+from stompest.config import StompConfig
+from stompest.sync import Stomp
+
+
+class AMQProducer(object):
+    """
+        Send AMQ messages over a persistent connection
+    """
+    def __init__(self, configuration, batch=False):
+        """
+            @param configuration: configuration object
+            @param batch: if True, messages are sent when flush() is called
+        """
+        self._stomp_config = StompConfig(configuration.failover_uri,
+                                         configuration.amq_user,
+                                         configuration.amq_pwd)
+        self._client = None
+        # Time at which the connection was last used
+        self._last_used = None
+        self.idle_timeout = configuration.amq_idle_timeout
+        self._lock = threading.RLock()
+        self.batch = batch
+        self._buffer = []
+        ## Number of messages sent over the current connection
+        self.sent_on_connection = 0
+        ## Number of connections opened
+        self.connections = 0
+        ## Total number of messages sent
+        self.sent = 0
+
+    def _connect(self):
+        """
+            Open the connection if it is not already open
+        """
+        if self._client is None:
+            t_0 = time.time()
+            client = Stomp(self._stomp_config)
+            client.connect()
+            profiling.record('connect', time.time() - t_0, name='amq_producer')
+            self._client = client
+            self._last_used = time.time()
+            self.connections += 1
+            self.sent_on_connection = 0
+
+    def _disconnect(self):
+        """
+            Close the connection, ignoring errors from a broken connection
+        """
+        if self._client is not None:
+            logging.debug("AMQ producer: %s messages sent on connection %s" % (self.sent_on_connection, self.connections))
+            try:
+                self._client.disconnect()
+            except:
+                logging.debug("AMQ producer: error closing connection: %s" % sys.exc_value)
+            self._client = None
+
+    def _send(self, destination, data):
+        """
+            Send a message, reconnecting once if the connection was lost
+            @param destination: AMQ queue to send to
+            @param data: payload of the message
+        """
+        if self._client is not None and time.time() - self._last_used > self.idle_timeout:
+            logging.debug("AMQ producer: connection idle for %g sec, reconnecting" % (time.time() - self._last_used))
+            self._disconnect()
+        try:
+            self._connect()
+            self._client.send(destination, data)
+        except:
+            logging.warning("AMQ producer: send failed, reconnecting: %s" % sys.exc_value)
+            self._disconnect()
+            self._connect()
+            self._client.send(destination, data)
+        self._last_used = time.time()
+        self.sent_on_connection += 1
+        self.sent += 1
+
+    def send(self, destination, data):
+        """
+            Send an AMQ message
+            @param destination: AMQ queue to send to
+            @param data: payload of the message
+        """
+        with self._lock:
+            if self.batch:
+                self._buffer.append((destination, data))
+            else:
+                self._send(destination, data)
+
+    def flush(self):
+        """
+            Send all the messages kept in batch mode
+        """
+        with self._lock:
+            while len(self._buffer) > 0:
+                destination, data = self._buffer[0]
+                self._send(destination, data)
+                self._buffer.pop(0)
+
+    def close(self):
+        """
+            Send pending messages and close the connection
+        """
+        with self._lock:
+            try:
+                self.flush()
+            finally:
+                self._disconnect()
+
+
+_producer = None
+
+def get_producer(configuration):
+    """
+        Returns the process-wide producer, creating it if needed
+        @param configuration: configuration object
+    """
+    global _producer
+    if _producer is None:
+        _producer = AMQProducer(configuration, batch=configuration.amq_batch_send)
+    return _producer
+
+def close_producer():
+    """
+        Close the process-wide producer, sending any pending message
+    """
+    global _producer
+    if _producer is not None:
+        _producer.close()
+        logging.info("AMQ producer: %s messages sent over %s connections" % (_producer.sent, _producer.connections))
+        _producer = None
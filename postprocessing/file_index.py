@@ -0,0 +1,335 @@
+"""
+    Index of the files of a directory tree, keyed by run number.
+
+    The index remembers the content and modification time of each
+    directory of the tree. When it is refreshed, only the directories
+    whose modification time changed are listed again, so that finding the
+    files of a run doesn't require walking the whole tree.
+
+    An index only pays off when it is reused, so indices are only kept
+    in long-lived processes, like the workers, which call keep_indices().
+    Other processes walk the directory tree once for each lookup.
+
+    Files are indexed under every group of digits in their name, so that
+    HYS_12345_event.nxs is found when looking for run 12345. Directories
+    that never contain data, like reduction_log, are not indexed.
+
+    Directories are listed with scandir when it is available, which
+    gives the type of each entry without an extra stat call. The size and
+    modification time of the files are taken when a directory is listed,
+    and files are stat'ed at most once for each refresh of the index.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import os
+import re
+import stat
+import time
+import logging
+import threading
+import fnmatch
+from collections import OrderedDict, namedtuple
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+## Groups of digits in a file name
+RUN_NUMBER_RE = re.compile(r'\d+')
+## Directories modified more recently than this, in seconds, are listed
+## again at the next refresh since files may still be appearing within
+## the resolution of the file system time stamps.
+MTIME_RESOLUTION = 2.0
+## Maximum number of indices kept by a process
+MAX_INDICES = 16
+## Names of the directories that are not indexed
+PRUNED_DIRECTORIES = ['reduction_log']
+## Location of the reduction output, relative to the proposal directory
+REDUCTION_OUTPUT_DIR = os.path.join('shared', 'autoreduce')
+
+## File found for a run, with its size and modification time
+FileRecord = namedtuple('FileRecord', ['path', 'name', 'size', 'mtime'])
+
+
+class DirectoryEntry(object):
+    """
+        Content of a directory at the time it was listed
+    """
+    def __init__(self, mtime, files, subdirs, stats):
+        """
+            @param mtime: modification time of the directory, or None to list it again next time
+            @param files: list of file names
+            @param subdirs: list of full paths of the sub-directories
+            @param stats: dictionary of file name: (size, mtime, refresh count when stat'ed)
+        """
+        self.mtime = mtime
+        self.files = files
+        self.subdirs = subdirs
+        self.stats = stats
+
+
+class FileIndex(object):
+    """
+        Files under a directory, by run number
+    """
+    def __init__(self, root, prune=PRUNED_DIRECTORIES):
+        """
+            @param root: top directory of the tree
+            @param prune: names of the directories that should not be indexed
+        """
+        self.root = os.path.normpath(root)
+        self.prune = set(prune)
+        # Directory path -> DirectoryEntry
+        self._dirs = {}
+        # Run number -> set of file paths
+        self._runs = {}
+        # Number of refreshes, to know which file stats are current
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _add_files(self, dirpath, files):
+        for name in files:
+            filepath = os.path.join(dirpath, name)
+            for run in set(RUN_NUMBER_RE.findall(name)):
+                self._runs.setdefault(run, set()).add(filepath)
+
+    def _remove_files(self, dirpath, files):
+        for name in files:
+            filepath = os.path.join(dirpath, name)
+            for run in set(RUN_NUMBER_RE.findall(name)):
+                paths = self._runs.get(run)
+                if paths is not None:
+                    paths.discard(filepath)
+                    if len(paths) == 0:
+                        del self._runs[run]
+
+    def _list_directory(self, dirpath, mtime):
+        """
+            List a directory and update the index with its content
+            @param dirpath: path of the directory
+            @param mtime: current modification time of the directory
+        """
+        previous = self._dirs.get(dirpath)
+        if previous is not None:
+            self._remove_files(dirpath, previous.files)
+
+        files = []
+        subdirs = []
+        stats = {}
+        for name, path, stat_info in _list_entries(dirpath, self.prune):
+            if stat_info is None:
+                subdirs.append(path)
+            else:
+                files.append(name)
+                stats[name] = (stat_info.st_size, stat_info.st_mtime, self._generation)
+
+        if time.time() - mtime < MTIME_RESOLUTION:
+            mtime = None
+        self._dirs[dirpath] = DirectoryEntry(mtime, files, subdirs, stats)
+        self._add_files(dirpath, files)
+
+    def refresh(self):
+        """
+            Bring the index up to date, listing only the directories that changed
+        """
+        with self._lock:
+            t_0 = time.time()
+            self._generation += 1
+            n_listed = 0
+            seen = set()
+            stack = [self.root]
+            while len(stack) > 0:
+                dirpath = stack.pop()
+                try:
+                    mtime = os.stat(dirpath).st_mtime
+                except OSError:
+                    continue
+                entry = self._dirs.get(dirpath)
+                if entry is None or entry.mtime != mtime:
+                    try:
+                        self._list_directory(dirpath, mtime)
+                        n_listed += 1
+                    except OSError:
+                        continue
+                seen.add(dirpath)
+                stack.extend(self._dirs[dirpath].subdirs)
+
+            # Forget directories that were removed
+            for dirpath in set(self._dirs.keys()) - seen:
+                self._remove_files(dirpath, self._dirs.pop(dirpath).files)
+            logging.debug("File index %s: %s directories, %s listed in %g sec" % (self.root, len(seen), n_listed,
+                                                                                 time.time() - t_0))
+
+    def find(self, run_number, under=None):
+        """
+            Returns the sorted list of files for a run
+            @param run_number: run number
+            @param under: only return files below this directory
+        """
+        with self._lock:
+            paths = list(self._runs.get(str(run_number), []))
+        if under is not None:
+            under = os.path.join(os.path.normpath(under), '')
+            paths = [p for p in paths if p.startswith(under)]
+        return sorted(paths)
+
+    def find_records(self, run_number, under=None, pattern=None):
+        """
+            Returns the list of FileRecord for a run. The size and modification
+            time come from the last refresh when the directory was listed then,
+            and files of directories that didn't change are stat'ed once.
+            @param run_number: run number
+            @param under: only return files below this directory
+            @param pattern: only return files whose name matches this pattern
+        """
+        records = []
+        for path in self.find(run_number, under):
+            dirpath, name = os.path.split(path)
+            if pattern is not None and not fnmatch.fnmatch(name, pattern):
+                continue
+            with self._lock:
+                entry = self._dirs.get(dirpath)
+                generation = self._generation
+                cached = entry.stats.get(name) if entry is not None else None
+            if cached is None or cached[2] != generation:
+                # The content of a file may change without its directory changing
+                try:
+                    stat_info = os.stat(path)
+                except OSError:
+                    # The file was removed since the index was refreshed
+                    continue
+                cached = (stat_info.st_size, stat_info.st_mtime, generation)
+                if entry is not None:
+                    with self._lock:
+                        entry.stats[name] = cached
+            records.append(FileRecord(path, name, cached[0], cached[1]))
+        return records
+
+
+def _list_entries(dirpath, prune, match=None):
+    """
+        List a directory and yield (name, path, stat result) for its files,
+        and (name, path, None) for its sub-directories. Like os.walk, links
+        to directories are not followed.
+        @param dirpath: path of the directory
+        @param prune: names of the sub-directories to leave out
+        @param match: if given, only stat and yield the files for which match(name) is True
+    """
+    if scandir is not None:
+        for item in scandir(dirpath):
+            try:
+                if item.is_dir(follow_symlinks=False):
+                    if item.name not in prune:
+                        yield item.name, item.path, None
+                elif match is None or match(item.name):
+                    stat_info = item.stat()
+                    if not stat.S_ISDIR(stat_info.st_mode):
+                        yield item.name, item.path, stat_info
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            try:
+                stat_info = os.lstat(path)
+                if stat.S_ISDIR(stat_info.st_mode):
+                    if name not in prune:
+                        yield name, path, None
+                    continue
+                if match is not None and not match(name):
+                    continue
+                if stat.S_ISLNK(stat_info.st_mode):
+                    stat_info = os.stat(path)
+                if not stat.S_ISDIR(stat_info.st_mode):
+                    yield name, path, stat_info
+            except OSError:
+                continue
+
+def scan_records(root, run_number, pattern=None):
+    """
+        Returns the list of FileRecord for a run, walking the directory tree once
+        @param root: top directory of the tree
+        @param run_number: run number
+        @param pattern: only return files whose name matches this pattern
+    """
+    run_number = str(run_number)
+    def match(name):
+        if pattern is not None and not fnmatch.fnmatch(name, pattern):
+            return False
+        return run_number in RUN_NUMBER_RE.findall(name)
+
+    records = []
+    stack = [os.path.normpath(root)]
+    while len(stack) > 0:
+        dirpath = stack.pop()
+        try:
+            for name, path, stat_info in _list_entries(dirpath, PRUNED_DIRECTORIES, match):
+                if stat_info is None:
+                    stack.append(path)
+                else:
+                    records.append(FileRecord(path, name, stat_info.st_size, stat_info.st_mtime))
+        except OSError:
+            continue
+    return sorted(records)
+
+
+_indices = OrderedDict()
+_indices_lock = threading.Lock()
+_keep_indices = False
+
+def keep_indices(keep=True):
+    """
+        Keep file indices between lookups. Only worth it in long-lived
+        processes, which will see other runs of the same proposals.
+        @param keep: if False, walk the directory tree for each lookup
+    """
+    global _keep_indices
+    _keep_indices = keep
+    if not keep:
+        with _indices_lock:
+            _indices.clear()
+
+def get_file_index(root, refresh=True):
+    """
+        Returns the file index of a directory tree, shared within this process
+        @param root: top directory of the tree
+        @param refresh: if True, bring the index up to date before returning it
+    """
+    root = os.path.normpath(root)
+    with _indices_lock:
+        index = _indices.pop(root, None)
+        if index is None:
+            index = FileIndex(root)
+        _indices[root] = index
+        while len(_indices) > MAX_INDICES:
+            _indices.popitem(last=False)
+    if refresh:
+        index.refresh()
+    return index
+
+def find_run_files(root, run_number, pattern=None):
+    """
+        Returns the list of FileRecord for a run, using the index of
+        the directory tree if indices are kept by this process
+        @param root: top directory of the tree
+        @param run_number: run number
+        @param pattern: only return files whose name matches this pattern
+    """
+    if _keep_indices:
+        return get_file_index(root).find_records(run_number, pattern=pattern)
+    return scan_records(root, run_number, pattern)
+
+def find_reduced_files(proposal_dir, instrument, run_number):
+    """
+        Returns the list of FileRecord for the reduction output of a run,
+        that is the files named INSTRUMENT_RUN* in the output directory
+        @param proposal_dir: top directory of the proposal
+        @param instrument: instrument short name
+        @param run_number: run number
+    """
+    output_dir = os.path.join(proposal_dir, REDUCTION_OUTPUT_DIR)
+    pattern = "%s_%s*" % (instrument, run_number)
+    return find_run_files(output_dir, run_number, pattern)
@@ -0,0 +1,285 @@
+"""
+    Process-wide pool of ICAT sessions.
+
+    The suds client is created once per process, and the parsed WSDL
+    is kept in a local cache so that new processes don't need to
+    download and parse it again. Sessions are kept open between
+    catalog tasks and refreshed when they have been idle for a while.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+import ConfigParser
+import collections
+import profiling
+
+ICAT_PROPERTIES = '/etc/autoreduce/icatclient.properties'
+## Location of the cache for the parsed WSDL
+WSDL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'postprocessing-suds')
+## Number of days the parsed WSDL is kept
+WSDL_CACHE_DAYS = 7
+## Idle time after which a session is refreshed before being used, in seconds
+REFRESH_INTERVAL = 600
+
+
+class ICATSessionPool(object):
+    """
+        ICAT client and pool of logged-in sessions
+    """
+    def __init__(self, properties_file=ICAT_PROPERTIES, url=None):
+        """
+            @param properties_file: file with the ICAT host and credentials
+            @param url: URL of the WSDL, to use instead of the one built from the properties
+        """
+        config = ConfigParser.RawConfigParser()
+        config.read(properties_file)
+        self._password = config.get('icat41', 'password')
+        if url is None:
+            url = "https://" + config.get('icat41', 'hostAndPort') + "/ICATService/ICAT?wsdl"
+        self.url = url
+        self._client = None
+        # Idle sessions, as (session ID, time of last use)
+        self._idle = []
+
+    def _get_client(self):
+        """
+            Create the suds client, using the WSDL cache
+        """
+        if self._client is None:
+            from suds.client import Client
+            from suds.cache import ObjectCache
+            cache = ObjectCache(location=WSDL_CACHE_DIR, days=WSDL_CACHE_DAYS)
+            t_0 = time.time()
+            self._client = Client(self.url, cache=cache)
+            logging.debug("ICAT client created in %g sec" % (time.time() - t_0))
+            profiling.record('connect', time.time() - t_0, name='icat')
+        return self._client
+
+    @property
+    def service(self):
+        return self._get_client().service
+
+    @property
+    def factory(self):
+        return self._get_client().factory
+
+    def _login(self):
+        """
+            Open a new ICAT session
+        """
+        credentials = self.factory.create("credentials")
+        entry = self.factory.create("credentials.entry")
+        entry.key = "username"
+        entry.value = "root"
+        credentials.entry.append(entry)
+        entry = self.factory.create("credentials.entry")
+        entry.key = "password"
+        entry.value = self._password
+        credentials.entry.append(entry)
+        return self.service.login("db", credentials)
+
+    def borrow(self):
+        """
+            Returns a session ID, re-using an idle session if possible
+        """
+        while len(self._idle) > 0:
+            session_id, last_used = self._idle.pop()
+            if time.time() - last_used < REFRESH_INTERVAL:
+                return session_id
+            try:
+                self.service.refresh(session_id)
+                return session_id
+            except:
+                logging.debug("ICAT session expired: %s" % sys.exc_value)
+        return self._login()
+
+    def release(self, session_id):
+        """
+            Give a session back to the pool
+            @param session_id: ICAT session ID
+        """
+        self._idle.append((session_id, time.time()))
+
+    def logout_all(self):
+        """
+            Close all idle sessions
+        """
+        while len(self._idle) > 0:
+            session_id, _ = self._idle.pop()
+            try:
+                self.service.logout(session_id)
+            except:
+                logging.error("ICAT logout failed: %s" % sys.exc_value)
+
+
+class DatasetBatch(object):
+    """
+        Write-behind buffer for new datasets. Datasets that belong to the
+        same investigation are created with a single createMany call,
+        either when the batch is full or when flush() is called.
+        If that call fails, the datasets are created one at a time so
+        that one bad dataset doesn't take the others down with it.
+        A callback can be given with each dataset, to report the result
+        once it is known.
+    """
+    def __init__(self, session_pool, max_size=20, max_delay=10.0):
+        """
+            @param session_pool: ICATSessionPool used to create the datasets
+            @param max_size: number of datasets after which the batch is sent
+            @param max_delay: time a dataset may wait in the batch, in seconds
+        """
+        self._pool = session_pool
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # Datasets waiting to be created, keyed by investigation ID,
+        # then by dataset name, as [dataset, list of callbacks]
+        self._pending = {}
+        # Time at which the oldest pending dataset was added
+        self._oldest = None
+
+    def __len__(self):
+        return sum([len(item) for item in self._pending.values()])
+
+    def add(self, investigation_id, dataset, callback=None):
+        """
+            Add a new dataset to the batch. A dataset with the same name
+            already waiting in the batch is replaced, since it could not be
+            found in the catalog by the run that was cataloged again.
+            @param investigation_id: ID of the investigation the dataset belongs to
+            @param dataset: dataset object, with its datafiles and parameters
+            @param callback: function called with None, or with an error message, once the dataset is created
+        """
+        if self._oldest is None:
+            self._oldest = time.time()
+        datasets = self._pending.setdefault(investigation_id, collections.OrderedDict())
+        callbacks = []
+        if dataset.name in datasets:
+            logging.info("Dataset %s was already waiting to be cataloged: replacing it" % dataset.name)
+            callbacks = datasets.pop(dataset.name)[1]
+        if callback is not None:
+            callbacks.append(callback)
+        datasets[dataset.name] = [dataset, callbacks]
+        logging.debug("Dataset %s waiting to be cataloged [%s in batch]" % (dataset.name, len(self)))
+        if len(self) >= self.max_size:
+            self.flush()
+
+    def time_left(self):
+        """
+            Returns the time before the batch is due to be sent,
+            or None if the batch is empty
+        """
+        if self._oldest is None:
+            return None
+        return max(0.0, self._oldest + self.max_delay - time.time())
+
+    @staticmethod
+    def _notify(callbacks, error=None):
+        """
+            Report the result of the creation of a dataset
+            @param callbacks: functions to call with the result
+            @param error: error message, or None if the dataset was created
+        """
+        for callback in callbacks:
+            try:
+                callback(error)
+            except:
+                logging.error("Could not report catalog result: %s" % sys.exc_value)
+
+    def flush(self):
+        """
+            Create all the pending datasets
+        """
+        self._oldest = None
+        if len(self._pending) == 0:
+            return
+        pending = self._pending
+        self._pending = {}
+        try:
+            session_id = self._pool.borrow()
+        except:
+            error = "Could not connect to ICAT: %s" % sys.exc_value
+            logging.error(error)
+            for datasets in pending.values():
+                for _, callbacks in datasets.values():
+                    self._notify(callbacks, error)
+            return
+        try:
+            for investigation_id, datasets in pending.items():
+                entries = datasets.values()
+                try:
+                    self._pool.service.createMany(session_id, [dataset for dataset, _ in entries])
+                    logging.info("Cataloged %s datasets for investigation %s" % (len(entries), investigation_id))
+                    for _, callbacks in entries:
+                        self._notify(callbacks)
+                    continue
+                except:
+                    logging.error("Could not catalog datasets %s together: %s" % (', '.join([str(d.name) for d, _ in entries]),
+                                                                                  sys.exc_value))
+                # Create the datasets one at a time, to only lose the bad ones
+                for dataset, callbacks in entries:
+                    try:
+                        self._pool.service.create(session_id, dataset)
+                        self._notify(callbacks)
+                    except:
+                        error = "Could not catalog dataset %s: %s" % (dataset.name, sys.exc_value)
+                        logging.error(error)
+                        self._notify(callbacks, error)
+        finally:
+            self._pool.release(session_id)
+
+_session_pool = None
+_dataset_batch = None
+
+def get_session_pool():
+    """
+        Returns the ICAT session pool of this process
+    """
+    global _session_pool
+    if _session_pool is None:
+        _session_pool = ICATSessionPool()
+    return _session_pool
+
+def get_dataset_batch(max_size=20, max_delay=10.0):
+    """
+        Returns the write-behind dataset batch of this process
+        @param max_size: number of datasets after which the batch is sent
+        @param max_delay: time a dataset may wait in the batch, in seconds
+    """
+    global _dataset_batch
+    if _dataset_batch is None:
+        _dataset_batch = DatasetBatch(get_session_pool(), max_size, max_delay)
+    return _dataset_batch
+
+def dataset_batch_time_left():
+    """
+        Returns the time before the write-behind batch is due to be sent,
+        or None if there is nothing waiting
+    """
+    if _dataset_batch is None:
+        return None
+    return _dataset_batch.time_left()
+
+def flush_dataset_batch():
+    """
+        Create the datasets waiting in the write-behind batch, if any
+    """
+    if _dataset_batch is not None:
+        _dataset_batch.flush()
+
+def close_session_pool():
+    """
+        Create pending datasets and log out of all the ICAT sessions of this process
+    """
+    global _session_pool, _dataset_batch
+    if _dataset_batch is not None:
+        try:
+            _dataset_batch.flush()
+        finally:
+            _dataset_batch = None
+    if _session_pool is not None:
+        _session_pool.logout_all()
+        _session_pool = None
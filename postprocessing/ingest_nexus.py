@@ -9,41 +9,41 @@
 """
 VERSION = "1.4.2"
 
-from suds.client import Client
-
-import nxs, os, logging
+import os, logging
 import ConfigParser
 from time_conversions import epochToISO8601
+from icat_client import get_session_pool
+from nexus_metadata import read_metadata
+from file_index import find_run_files
 from xml.sax import saxutils
 
 class IngestNexus():
-    def __init__(self, infilename):
+    def __init__(self, infilename, session_pool=None, batch=None):
+        """
+            @param infilename: path of the data file to catalog
+            @param session_pool: ICATSessionPool to get a session from
+            @param batch: DatasetBatch to add new datasets to, or None to create them right away
+        """
         self._infilename = infilename
-        config = ConfigParser.RawConfigParser()
-        config.read('/etc/autoreduce/icatclient.properties')
-        hostAndPort = config.get('icat41', 'hostAndPort')
-        password = config.get('icat41', 'password')
-        plugin = "db"
-        client = Client("https://" + hostAndPort + "/ICATService/ICAT?wsdl")
-        self._service = client.service
-        self._factory = client.factory
-
-        credentials = self._factory.create("credentials")
-        entry = self._factory.create("credentials.entry")
-        entry.key = "username"
-        entry.value = "root"
-        credentials.entry.append(entry)
-        entry = self._factory.create("credentials.entry")
-        entry.key = "password"
-        entry.value = password
-        credentials.entry.append(entry)
-
-        self._sessionId = self._service.login(plugin, credentials)
+        self._batch = batch
+        if session_pool is None:
+            session_pool = get_session_pool()
+        self._pool = session_pool
+        self._service = session_pool.service
+        self._factory = session_pool.factory
+        self._sessionId = session_pool.borrow()
 
     def logout(self):
-        self._service.logout(self._sessionId)
-
-    def execute(self):
+        # The session goes back to the pool to be used for the next run
+        self._pool.release(self._sessionId)
+
+    def execute(self, callback=None):
+        """
+            Catalog the data file. Returns True if a new dataset was left in
+            the write-behind batch, in which case callback is called with
+            None, or with an error message, once the dataset is created.
+            @param callback: function called when a dataset in the batch is created
+        """
         #find facility, investigation_type
         config = ConfigParser.RawConfigParser()
         config.read('/etc/autoreduce/icat4.cfg')
@@ -67,151 +67,105 @@ class IngestNexus():
         sample = self._factory.create("sample")
         sample.name = 'NONE'
 
-        #open nexus file
-        file = nxs.open(self._infilename, 'r')
-        for name, nxclass in file.entries():
-            if nxclass == "NXentry" and name != "entry-VETO":
-                listing = file.getentries()
-
-                #investigation name
-                if listing.has_key('experiment_identifier'):
-                    file.opendata('experiment_identifier')
-                    investigation.name = file.getdata()
-                    file.closedata()
-                else:
-                    investigation.name = "IPTS-0000"
-
-                #investigation title
-                if listing.has_key('title'):
-                    file.opendata('title')
-                    investigation_title = unicode(file.getdata(), errors='replace')
-                    investigation.title = investigation_title.encode('ascii', 'replace')
-                    file.closedata()
-                else:
-                    investigation.title = "NONE"
+        dataset = None
 
-                #create dataset
+        #read all the metadata we need in one pass
+        for _, entry in read_metadata(self._infilename):
+            #investigation name
+            if 'experiment_identifier' in entry:
+                investigation.name = entry['experiment_identifier']
+            else:
+                investigation.name = "IPTS-0000"
+
+            #investigation title
+            if 'title' in entry:
+                investigation_title = unicode(entry['title'], errors='replace')
+                investigation.title = investigation_title.encode('ascii', 'replace')
+            else:
+                investigation.title = "NONE"
+
+            #create dataset
+            if dataset is None:
                 dataset = self._factory.create("dataset")
 
-                #investigation run number
-                if listing.has_key('collection_identifier'):
-                    file.opendata('collection_identifier')
-                    investigation.visitId = str(file.getdata())
-                    file.closedata()
+            #investigation run number
+            if 'collection_identifier' in entry:
+                investigation.visitId = str(entry['collection_identifier'])
+            else:
+                investigation.visitId = "0"
+
+            #dataset run number
+            dataset.name = entry['run_number']
+
+            #dataset title
+            if 'title' in entry:
+                dataset_description = unicode(entry['title'], errors='replace')
+                dataset.description = dataset_description.encode('ascii', 'replace')
+
+            dsType = self._factory.create("datasetType")
+            dsType.id = config.get('DatasetType', 'experiment_raw')
+            dataset.type = dsType
+
+            #set dataset start time
+            if 'start_time' in entry:
+                if entry_count == 0 or dataset.startDate > entry['start_time']:
+                    dataset.startDate = entry['start_time']
+
+            #set dataset end time
+            if 'end_time' in entry:
+                if entry_count == 0 or dataset.endDate < entry['end_time']:
+                    dataset.endDate = entry['end_time']
+
+            #dataset proton_charge, total_counts and duration
+            protonCharge = protonCharge + entry['proton_charge']
+            totalCounts = totalCounts + entry['total_counts']
+            duration = duration + entry['duration']
+
+            #investigation instrument
+            if 'instrument' in entry:
+                instrument = self._factory.create("instrument")
+                instrument.name = entry['instrument']
+                instrument.id = config.get('Instrument', entry['instrument'].lower())
+                investigation.instrument = instrument
+
+            if 'sample' in entry:
+                listSample = entry['sample']
+                if 'name' in listSample:
+                    # Text stored in the Nexus file is XML escaped
+                    # ICAT unescapes it automatically, so we need to
+                    # do it here if we want to determine whether
+                    # the sample is already in the DB.
+                    sample_name = unicode(listSample['name'], errors='replace')
+                    sample.name = saxutils.unescape(sample_name.encode('ascii', 'replace'))
                 else:
-                    investigation.visitId = "0"
-
-                #dataset run number
-                file.opendata('run_number')
-                dataset.name = file.getdata()
-                file.closedata()
-
-                #dataset title
-                if listing.has_key('title'):
-                    file.opendata('title')
-                    dataset_description = unicode(file.getdata(), errors='replace')
-                    dataset.description = dataset_description.encode('ascii', 'replace')
-                    file.closedata()
-
-                dsType = self._factory.create("datasetType")
-                dsType.id = config.get('DatasetType', 'experiment_raw')
-                dataset.type = dsType
-
-                #set dataset start time
-                if listing.has_key('start_time'):
-                    file.opendata('start_time')
-                    if entry_count == 0:
-                        dataset.startDate = file.getdata()
-                    elif dataset.startDate > file.getdata():
-                        dataset.startDate = file.getdata()
-                    file.closedata()
-
-                #set dataset end time
-                if listing.has_key('end_time'):
-                    file.opendata('end_time')
-                    if entry_count == 0:
-                        dataset.endDate = file.getdata()
-                    elif dataset.endDate < file.getdata():
-                        dataset.endDate = file.getdata()
-                    file.closedata()
-
-                #dataset proton_charge
-                file.opendata('proton_charge')
-                protonCharge = protonCharge + file.getdata()
-                file.closedata()
-
-                #dataset total_counts
-                file.opendata('total_counts')
-                totalCounts = totalCounts + file.getdata()
-                file.closedata()
-
-                #dataset duration
-                file.opendata('duration')
-                duration = duration + file.getdata()
-                file.closedata()
-
-                #investigation instrument
-                file.opengroup('instrument')
-                file.opendata('name')
-                for attr,value in file.attrs():
-                    if attr == 'short_name':
-                        instrument = self._factory.create("instrument")
-                        instrument.name = value
-                        instrument.id = config.get('Instrument', value.lower())
-                        investigation.instrument = instrument
-                file.closedata()
-                file.closegroup()
-
-                if listing.has_key('sample'):
-                    file.opengroup('sample')
-                    listSample = file.getentries()
-                    if listSample.has_key('name'):
-                        file.opendata('name')
-                        # Text stored in the Nexus file is XML escaped
-                        # ICAT unescapes it automatically, so we need to
-                        # do it here if we want to determine whether
-                        # the sample is already in the DB.
-                        sample_name = unicode(file.getdata(), errors='replace')
-                        sample.name = saxutils.unescape(sample_name.encode('ascii', 'replace'))
-                        file.closedata()
-                    else:
-                        sample.name = "NONE"
-                    sampleParameters = []
-
-                    #set sample nature
-                    if listSample.has_key('nature'):
-                        file.opendata('nature')
-                        nature = file.getdata()
-                        file.closedata()
-                        if nature:
-                            parameterType = self._factory.create("parameterType")
-                            parameterType.id = config.get('ParameterType', 'nature')
-                            parameterType.applicableToSample = config.getboolean('ParameterType', 'nature_applicable_to_sample')
-                            sampleParameter = self._factory.create("sampleParameter")
-                            sampleParameter.type = parameterType
-                            sampleParameter.stringValue = nature
-                            sampleParameters.append(sampleParameter)
-
-                    if listSample.has_key('identifier'):
-                        file.opendata('identifier')
-                        identifier = file.getdata()
-                        file.closedata()
-
-                        if identifier:
-                            parameterType = self._factory.create("parameterType")
-                            parameterType.id = config.get('ParameterType', 'identifier')
-                            parameterType.applicableToSample = config.getboolean('ParameterType', 'identifier_applicable_to_sample')
-                            sampleParameter = self._factory.create("sampleParameter")
-                            sampleParameter.type = parameterType
-                            sampleParameter.stringValue = identifier
-                            sampleParameters.append(sampleParameter)
-
-                    if len(sampleParameters):
-                        sample.parameters = sampleParameters
-
-                    file.closegroup()
-
-        file.close()
+                    sample.name = "NONE"
+                sampleParameters = []
+
+                #set sample nature
+                nature = listSample.get('nature')
+                if nature:
+                    parameterType = self._factory.create("parameterType")
+                    parameterType.id = config.get('ParameterType', 'nature')
+                    parameterType.applicableToSample = config.getboolean('ParameterType', 'nature_applicable_to_sample')
+                    sampleParameter = self._factory.create("sampleParameter")
+                    sampleParameter.type = parameterType
+                    sampleParameter.stringValue = nature
+                    sampleParameters.append(sampleParameter)
+
+                identifier = listSample.get('identifier')
+                if identifier:
+                    parameterType = self._factory.create("parameterType")
+                    parameterType.id = config.get('ParameterType', 'identifier')
+                    parameterType.applicableToSample = config.getboolean('ParameterType', 'identifier_applicable_to_sample')
+                    sampleParameter = self._factory.create("sampleParameter")
+                    sampleParameter.type = parameterType
+                    sampleParameter.stringValue = identifier
+                    sampleParameters.append(sampleParameter)
+
+                if len(sampleParameters):
+                    sample.parameters = sampleParameters
+
+            entry_count += 1
 
         #set dataset parameters
         parameters = []
@@ -253,29 +207,27 @@ class IngestNexus():
 
         token=self._infilename.split("/")
         proposalDir = "/" + token[1] + "/" + token[2] + "/" + token[3]
-        for dirpath, dirnames, filenames in os.walk(proposalDir):
+        for record in find_run_files(proposalDir, dataset.name):
+            dirpath, filename = os.path.split(record.path)
             if dirpath.find("shared") == -1 and dirpath.find("data") == -1:
-                for filename in [f for f in filenames]:
-                    #if dataset.name in filename and os.path.islink(filename) != False:
-                    if dataset.name in filename:
-                        logging.info("Filename: %s" % filename)
-                        datafile = self._factory.create("datafile")
-                        filepath = os.path.join(dirpath,filename)
-                        extension = os.path.splitext(filename)[1][1:]
-                        datafile.name = filename
-                        datafile.location = filepath
-                        dfFormat = self._factory.create("datafileFormat")
-                        dfFormat.id = config.get('DatafileFormat', extension)
-                        datafile.datafileFormat = dfFormat
-                        modTime = os.path.getmtime(filepath)
-                        datafile.datafileCreateTime = epochToISO8601(modTime)
-                        datafile.fileSize = os.path.getsize(filepath)
-                        datafiles.append(datafile)
+                logging.info("Filename: %s" % filename)
+                datafile = self._factory.create("datafile")
+                extension = os.path.splitext(filename)[1][1:]
+                datafile.name = filename
+                datafile.location = record.path
+                dfFormat = self._factory.create("datafileFormat")
+                dfFormat.id = config.get('DatafileFormat', extension)
+                datafile.datafileFormat = dfFormat
+                datafile.datafileCreateTime = epochToISO8601(record.mtime)
+                datafile.fileSize = record.size
+                datafiles.append(datafile)
 
         dataset.datafiles = datafiles
 
-        dbDatasets = self._service.search(self._sessionId, "Dataset INCLUDE Datafile [name = '" + str(dataset.name) + "'] <-> Investigation <-> Instrument [name = '" + str(instrument.name) + "'] <-> DatasetType [name = 'experiment_raw']")
+        # Include the datafiles, parameters, investigation and sample of the dataset
+        dbDatasets = self._service.search(self._sessionId, "Dataset INCLUDE 1 [name = '" + str(dataset.name) + "'] <-> Investigation <-> Instrument [name = '" + str(instrument.name) + "'] <-> DatasetType [name = 'experiment_raw']")
 
+        queued = False
         if len(dbDatasets) == 0:
             dbInvestigations = self._service.search(self._sessionId, "Investigation INCLUDE Sample [name = '" + investigation.name + "' AND visitId = '" + investigation.visitId + "'] <-> Instrument [name = '" + instrument.name + "']")
 
@@ -312,11 +264,16 @@ class IngestNexus():
             else:
                 logging.error("ERROR, there should be only one investigation per instrument per investigation name")
 
-            # create new dataset
+            # create new dataset, along with its datafiles and parameters
             dataset.sample = sample
             dataset.investigation = investigation
-            datasetId = self._service.create(self._sessionId, dataset)
-            logging.debug("  datasetId: %s" % str(datasetId))
+            if self._batch is not None and getattr(investigation, 'id', None) is not None:
+                # In write-behind mode, datasets for the same investigation are created together
+                self._batch.add(investigation.id, dataset, callback)
+                queued = True
+            else:
+                datasetId = self._service.create(self._sessionId, dataset)
+                logging.debug("  datasetId: %s" % str(datasetId))
 
         elif len(dbDatasets) == 1:
             logging.debug("Run %s is already cataloged, updating catalog..." % dataset.name)
@@ -324,19 +281,25 @@ class IngestNexus():
             dbDataset = dbDatasets[0]
             logging.debug("  datasetId: %s" % str(dbDataset.id))
 
-            # update "one to many" relationships
+            # update "one to many" relationships, replacing the datafiles
+            # and parameters with a single call each
 
-            if hasattr(dbDataset, "datafiles"):
-                dfs = getattr(dbDataset, "datafiles")
-                self._service.deleteMany(self._sessionId, dfs)
+            old_entities = []
+            for item in ["datafiles", "parameters"]:
+                if hasattr(dbDataset, item):
+                    old_entities.extend(getattr(dbDataset, item))
+            if len(old_entities) > 0:
+                self._service.deleteMany(self._sessionId, old_entities)
 
             for df in datafiles:
                 df.dataset = dbDataset
-            self._service.createMany(self._sessionId, datafiles)
+            for parameter in parameters:
+                parameter.dataset = dbDataset
+            self._service.createMany(self._sessionId, datafiles + parameters)
 
             # update "many to one" relationships
 
-            ds = self._service.get(self._sessionId, "Dataset INCLUDE 1", dbDataset.id)
+            ds = dbDataset
             investigation.id = ds.investigation.id
 
             dbSamples = self._service.search(self._sessionId, "Sample <-> Investigation [id = '" + str(ds.investigation.id) + "']")
@@ -360,3 +323,4 @@ class IngestNexus():
 
         else:
             logging.error("ERROR, there should be only one dataset per run number per type experiment_raw")
+        return queued
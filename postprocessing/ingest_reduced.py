@@ -9,47 +9,41 @@
 """
 VERSION = "1.4.2"
 
-from suds.client import Client
-
-import os, glob, logging
+import os, logging
 import ConfigParser
 from time_conversions import epochToISO8601
+from icat_client import get_session_pool
+from file_index import find_reduced_files
 from datetime import datetime
 
 class IngestReduced():
-    def __init__(self, facilityName, instrumentName, investigationName, runNumber):
+    def __init__(self, facilityName, instrumentName, investigationName, runNumber, session_pool=None, files=None):
+        """
+            @param facilityName: facility name
+            @param instrumentName: instrument short name
+            @param investigationName: proposal name
+            @param runNumber: run number
+            @param session_pool: ICATSessionPool to get a session from
+            @param files: list of FileRecord for the reduced files, or None to look for them
+        """
         self._facilityName = facilityName
+        self._files = files
         self._instrumentName = instrumentName
         self._investigationName = investigationName
         self._runNumber = runNumber
-        config = ConfigParser.RawConfigParser()
-        config.read('/etc/autoreduce/icatclient.properties')
-        hostAndPort = config.get('icat41', 'hostAndPort')
-        password = config.get('icat41', 'password')
-        plugin = "db"
-
-        client = Client("https://" + hostAndPort + "/ICATService/ICAT?wsdl")
-        self._service = client.service
-        self._factory = client.factory
-
-        credentials = self._factory.create("credentials")
-        entry = self._factory.create("credentials.entry")
-        entry.key = "username"
-        entry.value = "root"
-        credentials.entry.append(entry)
-        entry = self._factory.create("credentials.entry")
-        entry.key = "password"
-        entry.value = password
-        credentials.entry.append(entry)
+        if session_pool is None:
+            session_pool = get_session_pool()
+        self._pool = session_pool
+        self._service = session_pool.service
+        self._factory = session_pool.factory
 
         logging.debug("Begin login at: %s" % datetime.now())
-        self._sessionId = self._service.login(plugin, credentials)
+        self._sessionId = session_pool.borrow()
         logging.debug("End login at: %s" % datetime.now())
 
     def logout(self):
-        logging.debug("Begin logout at: %s" % datetime.now())
-        self._service.logout(self._sessionId)
-        logging.debug("End logout at: %s" % datetime.now())
+        # The session goes back to the pool to be used for the next run
+        self._pool.release(self._sessionId)
 
     def execute(self):
         """
@@ -71,24 +65,24 @@ class IngestReduced():
         dataset.location = directory
         datafiles = []
 
-        pattern =  '*' + self._runNumber + '*'
-        for dirpath, dirnames, filenames in os.walk(directory):
-            listing = glob.glob(os.path.join(dirpath, pattern))
-            for filepath in listing:
-                filename =os.path.basename(filepath)
-                logging.info("Filename: %s" % filename)
-                datafile = self._factory.create("datafile")
-                datafile.location = filepath
-                datafile.name = filename
-                extension = os.path.splitext(filename)[1][1:]
-                dfFormat = self._factory.create("datafileFormat")
-                dfFormat.id = config.get('DatafileFormat', extension)
-                datafile.datafileFormat = dfFormat
-                modTime = os.path.getmtime(filepath)
-                datafile.datafileCreateTime = epochToISO8601(modTime)
-                datafile.fileSize = os.path.getsize(filepath)
-
-                datafiles.append(datafile)
+        if self._files is None:
+            proposal_dir = "/" + self._facilityName + "/" + self._instrumentName + "/" +  self._investigationName
+            self._files = find_reduced_files(proposal_dir, self._instrumentName, self._runNumber)
+        for record in self._files:
+            filepath = record.path
+            filename = record.name
+            logging.info("Filename: %s" % filename)
+            datafile = self._factory.create("datafile")
+            datafile.location = filepath
+            datafile.name = filename
+            extension = os.path.splitext(filename)[1][1:]
+            dfFormat = self._factory.create("datafileFormat")
+            dfFormat.id = config.get('DatafileFormat', extension)
+            datafile.datafileFormat = dfFormat
+            datafile.datafileCreateTime = epochToISO8601(record.mtime)
+            datafile.fileSize = record.size
+
+            datafiles.append(datafile)
 
         dataset.datafiles = datafiles
         dataset.type = dsType
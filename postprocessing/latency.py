@@ -0,0 +1,113 @@
+"""
+    End-to-end latency markers.
+
+    When "latency_file" is set in the configuration, the time at which a
+    message reaches each processing stage is added to its data dictionary,
+    under "stage_times", as seconds since the epoch:
+
+        received       the consumer received the message
+        admitted       a slot was free to process the message
+        spawned        the message was handed to a process or a worker
+        started        PostProcessAdmin started processing the message
+        job_submitted  the first reduction job was submitted
+        job_finished   the last reduction job finished
+        completed      processing of the message is done
+
+    The markers travel with the message to PostProcessAdmin and the
+    processors, and are also added to messages that already carry some.
+    Once a message is processed, a JSON record is appended to the
+    latency file:
+
+        {"queue": "/queue/REDUCTION.DATA_READY", "instrument": "EQSANS",
+         "run_number": "30892", "stages": {...}}
+
+    scripts/latency_summary.py reports latency percentiles for each stage.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import json
+import math
+import time
+import socket
+import logging
+
+## Key of the stage markers in the data dictionary
+STAGE_KEY = 'stage_times'
+## Processing stages, in order
+STAGES = ['received', 'admitted', 'spawned', 'started',
+          'job_submitted', 'job_finished', 'completed']
+
+# File the latency records are written to, or None if latency markers are off
+_latency_file = None
+
+
+def configure(configuration=None):
+    """
+        Turn latency markers on if a latency file is given in the configuration
+        @param configuration: configuration object
+    """
+    global _latency_file
+    _latency_file = None
+    if configuration is not None and len(getattr(configuration, 'latency_file', '').strip()) > 0:
+        _latency_file = configuration.latency_file
+
+def is_enabled():
+    """
+        Returns True if latency markers are turned on
+    """
+    return _latency_file is not None
+
+def mark(data, stage, first=False):
+    """
+        Record the time at which a message reaches a stage
+        @param data: data dictionary of the message
+        @param stage: name of the stage, one of STAGES
+        @param first: if True, keep the time already recorded for this stage
+    """
+    if not isinstance(data, dict) or (_latency_file is None and STAGE_KEY not in data):
+        return
+    stage_times = data.setdefault(STAGE_KEY, {})
+    if first and stage in stage_times:
+        return
+    stage_times[stage] = round(time.time(), 3)
+
+def write_record(queue, data):
+    """
+        Mark a message as completed and append its stage times to the latency file
+        @param queue: queue the message was received on
+        @param data: data dictionary of the message
+    """
+    if _latency_file is None or not isinstance(data, dict):
+        return
+    mark(data, 'completed')
+    record = {"queue": queue,
+              "instrument": str(data.get('instrument', '')).upper(),
+              "run_number": str(data.get('run_number', '')),
+              "host": socket.gethostname(),
+              "pid": os.getpid(),
+              "stages": data[STAGE_KEY]}
+    try:
+        # A single write in append mode, so that processes don't mix up their records
+        fd = os.open(_latency_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, json.dumps(record, sort_keys=True) + '\n')
+        finally:
+            os.close(fd)
+    except:
+        logging.error("Could not write latency record to %s: %s" % (_latency_file, sys.exc_value))
+
+def percentile(values, fraction):
+    """
+        Returns a percentile of a list of values, using the nearest rank
+        @param values: list of values
+        @param fraction: percentile, between 0 and 1
+    """
+    values = sorted(values)
+    if len(values) == 0:
+        return float('nan')
+    # The nearest rank is ceil(fraction * n), counting from 1. Rounding first
+    # keeps products like 0.1 * 30 = 3.0000000000000004 from going one rank up.
+    rank = int(math.ceil(round(fraction * len(values), 9))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
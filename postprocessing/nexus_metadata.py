@@ -0,0 +1,111 @@
+"""
+    Read the catalog metadata of a NeXus file in a single pass.
+
+    Only the small fields needed for cataloging and reporting are read,
+    each of them once. Event arrays are never read: a field is only read
+    if it is one of the known metadata fields and if it is small.
+
+    This module is used by ingest_nexus.py and scripts/ar-report.py,
+    and should work with both python 2 and python 3.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import sys
+import h5py
+
+## Fields read from each NXentry
+ENTRY_FIELDS = ['experiment_identifier', 'title', 'collection_identifier',
+                'run_number', 'start_time', 'end_time',
+                'proton_charge', 'total_counts', 'duration']
+## Fields read from the sample group of each NXentry
+SAMPLE_FIELDS = ['name', 'nature', 'identifier']
+## Largest number of elements a metadata field may have
+MAX_FIELD_SIZE = 1024
+## Entries that are not cataloged
+SKIPPED_ENTRIES = ['entry-VETO']
+
+
+def _to_native(value):
+    """
+        Convert a value read with h5py to a native python value.
+        Single-element arrays are reduced to their element, and
+        byte strings are returned as str.
+        @param value: value read from a data set or an attribute
+    """
+    if hasattr(value, 'shape') and hasattr(value, 'flat'):
+        if value.size == 1:
+            value = value.flat[0]
+        else:
+            return [_to_native(item) for item in value.flat]
+    if isinstance(value, bytes):
+        if sys.version_info[0] >= 3:
+            return value.decode('utf-8', 'replace')
+        return str(value)
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def _nx_class(item):
+    """
+        Returns the NeXus class of a group or data set
+        @param item: h5py object
+    """
+    return _to_native(item.attrs.get('NX_class', ''))
+
+
+def _read_fields(group, fields):
+    """
+        Read the requested fields of a group, skipping missing or large ones
+        @param group: h5py group
+        @param fields: list of field names
+    """
+    values = {}
+    for name in fields:
+        item = group.get(name)
+        if isinstance(item, h5py.Dataset) and item.size <= MAX_FIELD_SIZE:
+            values[name] = _to_native(item[()])
+    return values
+
+
+def read_entry(entry, fields=None):
+    """
+        Read the metadata of an NXentry. Returns a dictionary of the
+        entry fields, along with the short name of the instrument as
+        'instrument' and a dictionary of sample fields as 'sample'
+        when the entry has a sample group.
+        @param entry: h5py group of the entry
+        @param fields: list of entry fields to read, or None for all of them
+    """
+    if fields is None:
+        fields = ENTRY_FIELDS
+    metadata = _read_fields(entry, fields)
+
+    instrument = entry.get('instrument')
+    if isinstance(instrument, h5py.Group):
+        name = instrument.get('name')
+        if isinstance(name, h5py.Dataset) and 'short_name' in name.attrs:
+            metadata['instrument'] = _to_native(name.attrs['short_name'])
+
+    sample = entry.get('sample')
+    if isinstance(sample, h5py.Group):
+        metadata['sample'] = _read_fields(sample, SAMPLE_FIELDS)
+    return metadata
+
+
+def read_metadata(filename, fields=None):
+    """
+        Read the metadata of all the NXentry groups of a NeXus file.
+        Returns a list of (entry name, metadata dictionary) in file order.
+        @param filename: path of the NeXus file
+        @param fields: list of entry fields to read, or None for all of them
+    """
+    entries = []
+    with h5py.File(filename, 'r') as handle:
+        for name in handle:
+            if name in SKIPPED_ENTRIES:
+                continue
+            entry = handle[name]
+            if isinstance(entry, h5py.Group) and _nx_class(entry) == 'NXentry':
+                entries.append((name, read_entry(entry, fields)))
+    return entries
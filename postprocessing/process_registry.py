@@ -0,0 +1,94 @@
+"""
+    Book-keeping of the processes started by the consumer.
+
+    Processes are indexed by pid, and the number of running processes
+    is kept per instrument so that admission decisions do not depend
+    on how many processes or instruments are being tracked.
+    Process exit events are queued and applied when reap() is called.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import time
+import logging
+import collections
+
+
+class ProcessRecord(object):
+    """
+        Information about a running process
+    """
+    def __init__(self, proc, destination, instrument=None):
+        """
+            @param proc: process handle, with a pid attribute
+            @param destination: queue the message was received on
+            @param instrument: instrument name, or None
+        """
+        self.proc = proc
+        self.pid = proc.pid
+        self.destination = destination
+        self.instrument = instrument
+        self.start_time = time.time()
+
+
+class ProcessRegistry(object):
+    """
+        Registry of running processes
+    """
+    def __init__(self):
+        ## Running processes, keyed by pid
+        self.records = {}
+        ## Number of running processes for each instrument
+        self.instrument_counts = collections.defaultdict(int)
+        ## Processes that exited and are waiting to be removed
+        self.reap_queue = collections.deque()
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, proc, destination, instrument=None):
+        """
+            Register a new process
+            @param proc: process handle, with a pid attribute
+            @param destination: queue the message was received on
+            @param instrument: instrument name, or None
+        """
+        record = ProcessRecord(proc, destination, instrument)
+        self.records[record.pid] = record
+        if instrument is not None:
+            self.instrument_counts[instrument] += 1
+        return record
+
+    def process_ended(self, proc):
+        """
+            Queue an exit event for a process
+            @param proc: process handle that finished
+        """
+        self.reap_queue.append(proc)
+
+    def reap(self):
+        """
+            Remove the processes that exited and return their records
+        """
+        reaped = []
+        while len(self.reap_queue) > 0:
+            proc = self.reap_queue.popleft()
+            record = self.records.get(proc.pid, None)
+            # A worker's pid is reused for its next task, so check that
+            # the record is for this process handle
+            if record is None or record.proc is not proc:
+                logging.debug("Process %s was not registered" % proc.pid)
+                continue
+            del self.records[proc.pid]
+            if record.instrument is not None:
+                self.instrument_counts[record.instrument] -= 1
+                if self.instrument_counts[record.instrument] <= 0:
+                    del self.instrument_counts[record.instrument]
+            reaped.append(record)
+        return reaped
+
+    def instrument_count(self, instrument):
+        """
+            Returns the number of running processes for an instrument
+            @param instrument: instrument name
+        """
+        return self.instrument_counts.get(instrument, 0)
@@ -0,0 +1,101 @@
+"""
+    Registry of the processor plugins.
+
+    Processors are listed in the configuration as "module.Class", or as a
+    dictionary mapping an input queue to "module.Class" or "module:Class",
+    or to a list of them. Several processors can listen to the same queue,
+    and they are all called for each message.
+
+    The input queue of a processor is read from the _message_queue
+    attribute in the source of its class, so that it can be registered
+    without importing it. A processor is only imported when a message
+    arrives on its queue.
+
+    @copyright: 2014-2015 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import ast
+import logging
+import threading
+
+# Processor classes already imported, by "module.Class"
+_classes = {}
+_lock = threading.Lock()
+
+
+def normalize_name(name):
+    """
+        Returns a processor name in the "module.Class" format
+        @param name: "module.Class" or "module:Class"
+    """
+    name = name.replace(':', '.')
+    if len(name.split('.')) != 2:
+        raise ValueError("Processors can only be specified in the format module.Processor_class: %s" % name)
+    return name
+
+def load_processor(name):
+    """
+        Import a processor and return its class
+        @param name: "module.Class" or "module:Class"
+    """
+    name = normalize_name(name)
+    with _lock:
+        if name not in _classes:
+            module_name, class_name = name.split('.')
+            processor_module = __import__("postprocessing.processors.%s" % module_name,
+                                          globals(), locals(), [class_name, ], -1)
+            _classes[name] = getattr(processor_module, class_name)
+        return _classes[name]
+
+def read_input_queue(name):
+    """
+        Returns the _message_queue set in the source of a processor class,
+        or None if it is not set there as a string
+        @param name: "module.Class" or "module:Class"
+    """
+    module_name, class_name = normalize_name(name).split('.')
+    source_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "%s.py" % module_name)
+    if not os.path.isfile(source_file):
+        return None
+    with open(source_file, 'r') as fd:
+        tree = ast.parse(fd.read(), source_file)
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == class_name:
+            for item in node.body:
+                if isinstance(item, ast.Assign) and isinstance(item.value, ast.Str) \
+                    and '_message_queue' in [getattr(target, 'id', None) for target in item.targets]:
+                    return item.value.s
+    return None
+
+def get_input_queue(name):
+    """
+        Returns the input queue of a processor, importing it only
+        if the queue can't be read from its source
+        @param name: "module.Class" or "module:Class"
+    """
+    queue = read_input_queue(name)
+    if queue is None:
+        queue = load_processor(name).get_input_queue_name()
+    return queue
+
+def build_registry(processors):
+    """
+        Returns a dictionary mapping each input queue to the list of
+        names of the processors listening to it
+        @param processors: list of processor names, or dictionary of queue: processor name or list of names
+    """
+    registry = {}
+    if isinstance(processors, dict):
+        for queue, names in processors.items():
+            if not isinstance(names, list):
+                names = [names]
+            for name in names:
+                registry.setdefault(str(queue), []).append(normalize_name(name))
+    elif isinstance(processors, list):
+        for name in processors:
+            try:
+                registry.setdefault(get_input_queue(name), []).append(normalize_name(name))
+            except:
+                logging.error("Configuration: Error loading processor %s: %s", name, sys.exc_value)
+    return registry
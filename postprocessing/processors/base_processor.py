@@ -6,10 +6,13 @@
     @copyright: 2014-2015 Oak Ridge National Laboratory
 """
 import os
+import copy
 import logging
 import json
 import string
+import threading
 import job_handling
+import latency
 
 class BaseProcessor(object):
     """
@@ -36,6 +39,8 @@ class BaseProcessor(object):
             @param send_function: function to call to send an AMQ message
         """
         self.data = data
+        # Protects the data dictionary when jobs run in parallel
+        self._lock = threading.RLock()
         self.configuration = conf
         self._process_data(data)
         self._send_function = send_function
@@ -105,6 +110,8 @@ class BaseProcessor(object):
         if os.path.isfile(out_log):
             os.remove(out_log)
 
+        with self._lock:
+            latency.mark(self.data, 'job_submitted', first=True)
         if 'remote' in run_options and run_options['remote'] is True:
             node_request = None
             if "node_request" in job_info:
@@ -112,9 +119,19 @@ class BaseProcessor(object):
             job_id = job_handling.remote_submission(self.configuration, script, self.data_file, 
                                                     self.output_dir, out_log, out_err, 
                                                     wait, dependencies, node_request=node_request)
+            if wait:
+                with self._lock:
+                    latency.mark(self.data, 'job_finished')
         else:
+            # The log follower sends status messages from its own thread: give it a copy
+            with self._lock:
+                data = copy.deepcopy(self.data)
+            status_callback = job_handling.status_sender(self.configuration, data, self.send)
             job_id = job_handling.local_submission(self.configuration, script, self.data_file, 
-                                                   self.output_dir, out_log, out_err)
+                                                   self.output_dir, out_log, out_err,
+                                                   status_callback=status_callback)
+            with self._lock:
+                latency.mark(self.data, 'job_finished')
 
         return job_id, out_log, out_err
 
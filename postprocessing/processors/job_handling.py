@@ -8,6 +8,145 @@ import subprocess
 import time
 import os
 import re
+import sys
+import json
+import signal
+import string
+import threading
+from node_sizing import get_node_sizing_cache
+
+## Regular expression used to find error messages
+ERROR_RE = re.compile('Error: (.+)$')
+## Maximum number of bytes to scan at the end of an error file
+ERROR_SCAN_SIZE = 16 * 1024 * 1024
+## Regular expression for Mantid algorithm completion, e.g.
+## "Rebin-[Notice] Rebin successful, Duration 1 minutes 2.50 seconds"
+ALGORITHM_RE = re.compile(r'(\S+) successful, Duration (.+)$')
+
+class JobMonitor(object):
+    """
+        Keeps track of the status of jobs submitted to the batch system.
+        All the outstanding jobs are checked with a single qstat call.
+        The polling interval starts short and increases while no job
+        finishes, up to a maximum.
+    """
+    ## Job states for a finished job (Torque and PBS Pro)
+    FINISHED_STATES = ['C', 'F']
+    ## qstat errors for jobs that are no longer listed because they are done:
+    ## Torque, and PBS Pro with job history enabled
+    FINISHED_ERRORS = ['Unknown Job Id', 'Job has finished']
+
+    def __init__(self, configuration):
+        """
+            @param configuration: configuration object
+        """
+        self.qstat_command = configuration.qstat_command
+        self.min_interval = configuration.job_poll_interval_min
+        self.max_interval = configuration.job_poll_interval_max
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._new_job = threading.Event()
+        self._thread = None
+
+    def watch(self, job_id):
+        """
+            Start watching a job and return an event that will be
+            set when the job is done.
+            @param job_id: ID of the job returned by qsub
+        """
+        job_id = str(job_id).split('.')[0]
+        with self._lock:
+            if job_id not in self._jobs:
+                self._jobs[job_id] = threading.Event()
+            finished = self._jobs[job_id]
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="JobMonitor")
+                self._thread.daemon = True
+                self._thread.start()
+        # Poll soon, so that short jobs are picked up quickly
+        self._new_job.set()
+        return finished
+
+    def wait(self, job_id, timeout=None):
+        """
+            Wait for a job to finish. Returns True if the job is done.
+            @param job_id: ID of the job returned by qsub
+            @param timeout: maximum time to wait, in seconds
+        """
+        return self.watch(job_id).wait(timeout)
+
+    def query(self, job_ids):
+        """
+            Returns the state of each job as a dictionary.
+            Jobs unknown to the batch system, or finished and only kept
+            in the PBS Pro job history, are not in the dictionary.
+            Returns None if the batch system could not be queried.
+            @param job_ids: list of job IDs
+        """
+        cmd = [self.qstat_command, '-f'] + job_ids
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc_out, proc_err = proc.communicate()
+        if proc.returncode != 0 and len(proc_out.strip()) == 0 \
+            and not any([message in proc_err for message in self.FINISHED_ERRORS]):
+            logging.error("Could not get job status: %s" % proc_err.strip())
+            return None
+
+        states = {}
+        job_id = None
+        for line in proc_out.splitlines():
+            if line.startswith("Job Id:"):
+                job_id = line.split(':', 1)[1].strip().split('.')[0]
+                states[job_id] = None
+            elif job_id is not None and line.strip().startswith("job_state"):
+                states[job_id] = line.split('=', 1)[1].strip()
+        return states
+
+    def _run(self):
+        """
+            Poll the batch system until all the jobs are done
+        """
+        interval = self.min_interval
+        while True:
+            with self._lock:
+                job_ids = self._jobs.keys()
+                if len(job_ids) == 0:
+                    self._thread = None
+                    return
+            self._new_job.clear()
+
+            n_finished = 0
+            try:
+                states = self.query(job_ids)
+            except:
+                logging.error("Could not get job status: %s" % sys.exc_value)
+                states = None
+            if states is not None:
+                for job_id in job_ids:
+                    if job_id not in states or states[job_id] in self.FINISHED_STATES:
+                        logging.debug("Job %s is done" % job_id)
+                        with self._lock:
+                            self._jobs.pop(job_id).set()
+                        n_finished += 1
+
+            # Back off while nothing happens
+            if n_finished > 0:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+            if self._new_job.wait(interval):
+                interval = self.min_interval
+
+_job_monitor = None
+
+def get_job_monitor(configuration):
+    """
+        Returns the job monitor shared by all the jobs of this process
+        @param configuration: configuration object
+    """
+    global _job_monitor
+    if _job_monitor is None:
+        _job_monitor = JobMonitor(configuration)
+    return _job_monitor
 
 def remote_submission(configuration, script, input_file, 
                       output_dir, out_log, out_err, wait=True,
@@ -34,10 +173,8 @@ def remote_submission(configuration, script, input_file,
     #MaxChunkSize is set to 8G specifically for the jobs run on fermi, which has 32 nodes and 64GB/node
     #We would like to get MaxChunkSize from an env variable in the future
     elif configuration.comm_only is False:
-        import mantid.simpleapi as api
-        chunks = api.DetermineChunking(Filename=input_file,
-                                       MaxChunkSize=configuration.max_memory)
-        nodes_desired = min(chunks.rowCount(), configuration.max_nodes)
+        chunks = get_node_sizing_cache(configuration).get_chunks(input_file, configuration.max_memory)
+        nodes_desired = min(chunks, configuration.max_nodes)
         if nodes_desired == 0:
             nodes_desired = 1
     else:
@@ -72,27 +209,153 @@ def remote_submission(configuration, script, input_file,
     logging.info("Job ID: %s" % pid)
 
     # Wait for the job to finish
-    t_0 = time.time()
-    t_cycle = t_0
-    while wait:
-        qstat_cmd = "qstat " + pid
-        ret = subprocess.Popen(qstat_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True).stdout.read().rstrip()
-        logging.debug("Popen return code: " + ret)
-        if ret.startswith("qstat: Unknown Job Id") or \
-           ret.endswith("C batch") or \
-           len(ret)==0:
-            break
-        else:
-            time.sleep(30)
+    if wait:
+        finished = get_job_monitor(configuration).watch(pid)
+        t_0 = time.time()
         # If we've been waiting for more than a configured waiting time,
         # log the event as information
-        if time.time()-t_cycle > configuration.wait_notification_period:
+        while not finished.wait(configuration.wait_notification_period):
             wait_time = time.time()-t_0
-            t_cycle = time.time()
             logging.info("Waiting for job ID %s for more than %g seconds" % (pid, wait_time))
     return pid
 
-def local_submission(configuration, script, input_file, output_dir, out_log, out_err):
+def parse_duration(text):
+    """
+        Returns the number of seconds in a Mantid duration string,
+        such as "2.5 seconds" or "1 minutes 2.5 seconds"
+        @param text: duration string
+    """
+    toks = text.split()
+    seconds = 0.
+    for i in range(0, len(toks)-1, 2):
+        value = float(toks[i])
+        if toks[i+1].startswith('hour'):
+            seconds += 3600. * value
+        elif toks[i+1].startswith('min'):
+            seconds += 60. * value
+        else:
+            seconds += value
+    return seconds
+
+
+class LogFollower(object):
+    """
+        Follows the log files of a running job. Completed Mantid algorithms
+        are reported as progress, and error messages are reported as soon
+        as they appear.
+    """
+    def __init__(self, configuration, out_log, out_err, status_callback=None):
+        """
+            @param configuration: configuration object
+            @param out_log: job log file
+            @param out_err: job error file
+            @param status_callback: function called with an event name and a dictionary
+        """
+        self.configuration = configuration
+        self.status_callback = status_callback
+        self._files = [[out_log, 0, ''], [out_err, 0, '']]
+        self.t_0 = time.time()
+        self._last_progress = self.t_0
+        self._reported = 0
+        ## Number of algorithms completed
+        self.n_algorithms = 0
+        self.last_algorithm = None
+        self.longest_algorithm = None
+        self.longest_duration = 0.
+        ## First error that was not in the list of exceptions
+        self.error = None
+
+    def poll(self, final=False):
+        """
+            Read what was added to the log files since the last call.
+            Returns True if an error that should stop the job was found.
+            @param final: if True, the job is done and partial lines are processed
+        """
+        found_error = False
+        for item in self._files:
+            file_name, position, partial = item
+            try:
+                with open(file_name, 'r') as fd:
+                    fd.seek(position)
+                    content = fd.read()
+                    item[1] = fd.tell()
+            except IOError:
+                continue
+            lines = (partial + content).split('\n')
+            item[2] = lines.pop()
+            if final and len(item[2]) > 0:
+                lines.append(item[2])
+                item[2] = ''
+            for line in lines:
+                found_error = self._process_line(line) or found_error
+
+        if self.status_callback is not None and self.n_algorithms > self._reported \
+            and (final or time.time() - self._last_progress > self.configuration.progress_interval):
+            self._last_progress = time.time()
+            self._reported = self.n_algorithms
+            self.status_callback("progress", {"algorithms": self.n_algorithms,
+                                              "last_algorithm": self.last_algorithm,
+                                              "longest_algorithm": self.longest_algorithm,
+                                              "longest_duration": self.longest_duration,
+                                              "elapsed": time.time() - self.t_0})
+        return found_error
+
+    def _process_line(self, line):
+        """
+            Process a single log line. Returns True if the line contains
+            an error that is not in the list of exceptions.
+            @param line: log line
+        """
+        result = ALGORITHM_RE.search(line)
+        if result is not None:
+            self.n_algorithms += 1
+            self.last_algorithm = result.group(1)
+            try:
+                duration = parse_duration(result.group(2))
+                if duration > self.longest_duration:
+                    self.longest_duration = duration
+                    self.longest_algorithm = self.last_algorithm
+            except ValueError:
+                logging.debug("Could not parse duration: %s" % line)
+            return False
+
+        result = ERROR_RE.search(line)
+        if result is None or self.error is not None:
+            return False
+        error_line = result.group(1).strip()
+        if self.configuration.exceptions_re is not None \
+            and self.configuration.exceptions_re.search(error_line):
+            return False
+        self.error = error_line
+        if self.status_callback is not None:
+            self.status_callback("error", {"error": "REDUCTION: %s" % error_line,
+                                           "elapsed": time.time() - self.t_0})
+        return True
+
+def status_sender(configuration, data, send_function):
+    """
+        Returns a function that publishes job status events on the
+        service status topic of the instrument
+        @param configuration: configuration object
+        @param data: data dictionary of the run
+        @param send_function: function to call to send an AMQ message
+    """
+    if send_function is None or 'instrument' not in data:
+        return None
+    topic = string.Template(configuration.service_status).safe_substitute(instrument=str(data['instrument']).upper())
+
+    def _send(event, info):
+        try:
+            message = dict(data)
+            message.update(info)
+            message['event'] = event
+            send_function(topic, json.dumps(message))
+        except:
+            logging.error("Could not send job status: %s" % sys.exc_value)
+    return _send
+
+def local_submission(configuration, script, input_file, output_dir, out_log, out_err,
+                     status_callback=None):
     """
         Run a script locally
         @param configuration: configuration object
@@ -101,18 +364,65 @@ def local_submission(configuration, script, input_file, output_dir, out_log, out
         @param output_dir: reduction output directory
         @param out_log: reduction log file
         @param out_err: reduction error file
+        @param status_callback: function called with progress and error events
     """
     cmd = "%s %s %s %s/" % (configuration.python_executable, script, input_file, output_dir)
     logFile=open(out_log, "w")
     errFile=open(out_err, "w")
     if configuration.comm_only is False:
-        proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+        # Start the job in its own process group so that we can stop it
+        # along with the processes it started. This is done with the setsid
+        # command rather than preexec_fn, which is not safe when other
+        # threads are running, as with parallel job trees. The shell and
+        # setsid exec the job, so its process group ID is proc.pid.
+        proc = subprocess.Popen("exec setsid " + cmd, shell=True, stdin=subprocess.PIPE,
                                 stdout=logFile, stderr=errFile, universal_newlines = True,
                                 cwd=output_dir)
-        proc.communicate()
+        proc.stdin.close()
+        follower = LogFollower(configuration, out_log, out_err, status_callback)
+        next_poll = time.time() + configuration.log_follow_interval
+        while proc.poll() is None:
+            time.sleep(0.1)
+            if time.time() < next_poll:
+                continue
+            next_poll = time.time() + configuration.log_follow_interval
+            if follower.poll() and configuration.kill_on_error:
+                logging.error("Stopping job %s: %s" % (proc.pid, follower.error))
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except OSError:
+                    logging.error("Could not stop job %s: %s" % (proc.pid, sys.exc_value))
+                proc.wait()
+        follower.poll(final=True)
     logFile.close()
     errFile.close()
 
+def read_lines_backward(file_name, block_size=65536, max_size=None):
+    """
+        Generator returning the lines of a file, starting from the end.
+        The file is read in blocks so that memory use doesn't depend on its size.
+        @param file_name: path of the file to read
+        @param block_size: size of the blocks to read, in bytes
+        @param max_size: maximum number of bytes to read from the end of the file
+    """
+    with open(file_name, 'r') as fd:
+        fd.seek(0, os.SEEK_END)
+        position = fd.tell()
+        start = 0
+        if max_size is not None:
+            start = max(position - max_size, 0)
+        remainder = ''
+        while position > start:
+            read_size = min(block_size, position - start)
+            position -= read_size
+            fd.seek(position)
+            lines = (fd.read(read_size) + remainder).split('\n')
+            # The first line may be incomplete, keep it for the next block
+            remainder = lines[0]
+            for line in reversed(lines[1:]):
+                yield line
+        yield remainder
+
 def determine_success_local(configuration, out_err):
     """
         Determine whether we generated an error
@@ -122,26 +432,26 @@ def determine_success_local(configuration, out_err):
     success = not os.path.isfile(out_err) or os.stat(out_err).st_size == 0
     data = {}
     if not success:
-        # Go through each line and report the error message.
-        # If we can't fine the actual error, report the last line
+        # Look for the last error message, starting from the end of the file.
+        # If we can't find the actual error, report the last line
         last_line = None
         error_line = None
-        fp = file(out_err, "r")
-        for l in fp.readlines():
-            if len(l.replace('-', '').strip()) > 0:
+        for l in read_lines_backward(out_err, max_size=ERROR_SCAN_SIZE):
+            if last_line is None and len(l.replace('-', '').strip()) > 0:
                 last_line = l.strip()
-            result = re.search('Error: (.+)$', l)
+            result = ERROR_RE.search(l)
             if result is not None:
                 error_line = result.group(1)
+                break
         if error_line is None:
             error_line = last_line
-        for item in configuration.exceptions:
-            if re.search(item, error_line):
-                success = True
-                data["information"] = error_line
-                logging.error("Reduction error ignored: %s" % error_line)
+        if error_line is not None and configuration.exceptions_re is not None \
+            and configuration.exceptions_re.search(error_line):
+            success = True
+            data["information"] = error_line
+            logging.error("Reduction error ignored: %s" % error_line)
 
         if not success:
             data["error"] = "REDUCTION: %s" % error_line
 
-    return success, data
\ No newline at end of file
+    return success, data
@@ -9,10 +9,90 @@
 """
 from base_processor import BaseProcessor
 import os
+import sys
+import copy
 import json
+import time
 import socket
+import logging
+import threading
 import job_handling
 
+
+class JobPlan(object):
+    """
+        Validated job tree, with the jobs sorted according to their dependencies
+    """
+    def __init__(self, config):
+        """
+            @param config: content of a reduce_[instrument].config file
+        """
+        # Check for completeness
+        for key in ['jobs', 'run_options', 'common_properties']:
+            if key not in config.keys():
+                raise ValueError("No '%s' key in configuration" % key)
+        self.config = config
+        self.levels = self.sort_jobs(config['jobs'])
+        self.order = [name for level in self.levels for name in level]
+
+    @staticmethod
+    def sort_jobs(jobs):
+        """
+            Sort jobs according to their dependencies using Kahn's algorithm.
+            Returns a list of levels, each level being a list of jobs that
+            only depend on jobs from earlier levels.
+            @param jobs: dictionary of job descriptions
+        """
+        n_predecessors = {}
+        successors = dict([(name, []) for name in jobs])
+        for name, job in jobs.iteritems():
+            predecessors = set(job.get('predecessors', []))
+            for pred in predecessors:
+                if pred not in jobs:
+                    raise ValueError("Predecessor '%s' of job '%s' does not exist" % (pred, name))
+                successors[pred].append(name)
+            n_predecessors[name] = len(predecessors)
+
+        levels = []
+        current = sorted([name for name in jobs if n_predecessors[name] == 0])
+        n_sorted = 0
+        while len(current) > 0:
+            levels.append(current)
+            n_sorted += len(current)
+            next_level = []
+            for name in current:
+                for succ in successors[name]:
+                    n_predecessors[succ] -= 1
+                    if n_predecessors[succ] == 0:
+                        next_level.append(succ)
+            current = sorted(next_level)
+
+        if n_sorted < len(jobs):
+            cycle = sorted([name for name in jobs if n_predecessors[name] > 0])
+            raise ValueError("Circular dependency between jobs: %s" % ', '.join(cycle))
+        return levels
+
+## Job plans, keyed by configuration file path
+_job_plans = {}
+
+def load_job_plan(config_file):
+    """
+        Returns the job plan for a configuration file. The plan is
+        only re-computed when the file changes.
+        @param config_file: path of the reduce_[instrument].config file
+    """
+    stat = os.stat(config_file)
+    file_id = (stat.st_mtime, stat.st_size)
+    if config_file in _job_plans and _job_plans[config_file][0] == file_id:
+        return _job_plans[config_file][1]
+
+    with open(config_file, 'r') as fd:
+        config = json.load(fd)
+    plan = JobPlan(config)
+    _job_plans[config_file] = (file_id, plan)
+    return plan
+
+
 class JobTreeProcessor(BaseProcessor):
     """
         Process used to execute a list of inter-dependent jobs.
@@ -56,45 +136,29 @@ class JobTreeProcessor(BaseProcessor):
             return
 
         # Process the config file
-        content = open(config_file, 'r').read()
-        config = json.loads(content)
-        # Check for completeness
-        for key in ['jobs', 'run_options', 'common_properties']:
-            if key not in config.keys():
-                self.process_error(self.configuration.reduction_error, "No '%s' key in configuration" % key)
-                return
-        # Order up the jobs
-        job_submission = []
-        jobs_sorted = False
-        while(jobs_sorted is False):
-            for name, job in config['jobs'].iteritems():
-                if name in job_submission:
-                    continue
-                # If we don't have a predecessor, just add the job to the submission list
-                if 'predecessors' not in job.keys():
-                    job_submission.append(name)
-                else:
-                    # Loop through predecessors
-                    can_submit = True
-                    for pred in job['predecessors']:
-                        if pred in config['jobs']:
-                            can_submit = can_submit and pred in job_submission
-                        else:
-                            self.process_error(self.configuration.reduction_error, 
-                                               "Predecessor '%s' does not exist" % pred)
-                    if can_submit:
-                        job_submission.append(name)
-
-            jobs_sorted = len(job_submission) >= len(config['jobs'].keys())
+        try:
+            plan = load_job_plan(config_file)
+        except:
+            self.process_error(self.configuration.reduction_error, str(sys.exc_value))
+            return
+        # The plan is shared between runs, so work on a copy
+        config = copy.deepcopy(plan.config)
+        job_submission = list(plan.order)
 
-        # Run the jobs in order
-        self.run_jobs(job_submission, config['jobs'], config['run_options'], config['common_properties'])
+        # Run the jobs in order. Local jobs that don't depend on each other can run in parallel.
+        run_options = config['run_options']
+        if 'remote' in run_options and run_options['remote'] is True:
+            self.run_jobs(job_submission, config['jobs'], run_options, config['common_properties'])
+        else:
+            max_jobs = run_options.get('max_parallel_jobs', self.configuration.max_parallel_jobs)
+            self.run_jobs_parallel(job_submission, config['jobs'], run_options,
+                                   config['common_properties'], max_jobs)
 
         return job_submission
 
     def run_jobs(self, job_order, job_info, run_options, common_properties):
         """
-            Run a list of jobs
+            Submit a list of remote jobs
 
             job_info is a dictionary containing the following information:
             job_info = {
@@ -110,17 +174,15 @@ class JobTreeProcessor(BaseProcessor):
             @param run_options: general run options for submitting the jobs
             @param common_properties: common properties for the jobs
         """
-        # Run each job, one at a time, in order
+        # Submit each job, in order
         job_ids = {}
         has_errors = False
         for i in range(len(job_order)):
             item = job_order[i]
 
-            # For remote jobs, only wait on the last job and let the scheduling system
+            # Only wait on the last job and let the scheduling system
             # take care of the dependencies
-            wait = 'remote' in run_options and run_options['remote'] is True and i == len(job_order)-1
-            if not 'remote' in run_options or run_options['remote'] is False:
-                wait = i == len(job_order)-1
+            wait = i == len(job_order)-1
 
             if item in job_info:
                 # Check for completeness
@@ -168,3 +230,135 @@ class JobTreeProcessor(BaseProcessor):
             else:
                 self.process_error(self.configuration.reduction_error, 
                                    "JobTreeProcessor: job %s does not exist in job dictionary" % item)
+
+    def process_error(self, destination, message):
+        """
+            Log and send error message
+
+            @param destination: queue to send the error to
+            @param message: error message
+        """
+        with self._lock:
+            super(JobTreeProcessor, self).process_error(destination, message)
+
+    def _run_local_job(self, item, job_info, run_options, common_properties):
+        """
+            Run a local job and determine whether it succeeded.
+            Returns a tuple with the success flag, the status data and the duration.
+            @param item: name of the job
+            @param job_info: job description dictionary
+            @param run_options: general run options for submitting the jobs
+            @param common_properties: common properties for the jobs
+        """
+        t_0 = time.time()
+        try:
+            _, _, out_err = self._run_job(item, job_info, run_options,
+                                          dict(common_properties), True)
+            success, status_data = job_handling.determine_success_local(self.configuration, out_err)
+            if success and os.path.isfile(out_err):
+                os.remove(out_err)
+        except:
+            success = False
+            status_data = {"error": "JobTreeProcessor: job [%s] failed: %s" % (item, sys.exc_value)}
+        return success, status_data, time.time() - t_0
+
+    def run_jobs_parallel(self, job_order, job_info, run_options, common_properties, max_jobs=1):
+        """
+            Run a list of local jobs, starting each job as soon as all its
+            predecessors have succeeded. Jobs depending on a job that failed
+            are skipped.
+
+            @param job_order: list of job names, ordered so that predecessors come first
+            @param job_info: dictionary describing each job
+            @param run_options: general run options for submitting the jobs
+            @param common_properties: common properties for the jobs
+            @param max_jobs: maximum number of jobs running at the same time
+        """
+        max_jobs = max(int(max_jobs), 1)
+        # Status of each job: 'success', 'failed' or 'skipped'
+        status = {}
+        waiting = []
+        for item in job_order:
+            if item not in job_info:
+                self.process_error(self.configuration.reduction_error,
+                                   "JobTreeProcessor: job %s does not exist in job dictionary" % item)
+                status[item] = 'failed'
+            elif 'script' not in job_info[item] and 'algorithm' not in job_info[item]:
+                self.process_error(self.configuration.reduction_error,
+                                   "JobTreeProcessor: no job to run for [%s]" % item)
+                status[item] = 'failed'
+            else:
+                waiting.append(item)
+
+        results = {}
+        timing = {}
+        running = {}
+        finished = threading.Condition()
+
+        def _run(item):
+            result = self._run_local_job(item, job_info[item], run_options, common_properties)
+            with finished:
+                results[item] = result
+                finished.notify()
+
+        with finished:
+            while len(waiting) > 0 or len(running) > 0:
+                # Start every job whose predecessors are done
+                for item in list(waiting):
+                    predecessors = job_info[item].get('predecessors', [])
+                    blocked = [p for p in predecessors if status.get(p, None) not in [None, 'success'] \
+                               or (p not in job_info and p not in status)]
+                    if len(blocked) > 0:
+                        waiting.remove(item)
+                        status[item] = 'skipped'
+                        logging.error("JobTreeProcessor: skipping [%s], predecessor failed: %s" % (item, ', '.join(blocked)))
+                        continue
+                    if len(running) >= max_jobs:
+                        continue
+                    if len([p for p in predecessors if status.get(p, None) != 'success']) == 0:
+                        waiting.remove(item)
+                        with self._lock:
+                            self.data['information'] = "Job [%s] started on %s" % (item, socket.gethostname())
+                            self.send('/queue/'+self.configuration.reduction_started, json.dumps(self.data))
+                        thread = threading.Thread(target=_run, args=(item,), name="job-%s" % item)
+                        thread.daemon = True
+                        running[item] = thread
+                        thread.start()
+
+                if len(running) == 0:
+                    # Nothing can start: the remaining jobs depend on each other
+                    for item in waiting:
+                        status[item] = 'skipped'
+                        logging.error("JobTreeProcessor: skipping [%s], predecessors can't run" % item)
+                    waiting = []
+                    continue
+                finished.wait()
+
+                # Process the jobs that finished
+                for item in [i for i in running if i in results]:
+                    running.pop(item).join()
+                    success, status_data, duration = results.pop(item)
+                    timing[item] = duration
+                    status[item] = 'success' if success else 'failed'
+                    logging.info("JobTreeProcessor: job [%s] %s in %g seconds" % (item, status[item], duration))
+                    with self._lock:
+                        self.data.update(status_data)
+                        if not success:
+                            self.send('/queue/'+self.configuration.reduction_error, json.dumps(self.data))
+
+        logging.info("JobTreeProcessor: job durations: %s" % ', '.join(["%s=%.1fs" % (k, timing[k]) for k in job_order if k in timing]))
+
+        # When all the jobs are done, send the final success message
+        # Report the last job in dependency order, which is the final job of the tree
+        # when it has one, rather than whichever job happened to finish last
+        has_errors = len([k for k in status if status[k] != 'success']) > 0
+        if len(job_order) > 0 and not has_errors:
+            # Make sure we send the success message to the right place
+            success_queue = self.configuration.reduction_complete
+            last_item = job_order[-1]
+            if 'success_queue' in job_info[last_item]:
+                success_queue = job_info[last_item]['success_queue']
+            with self._lock:
+                self.data['information'] = "Last job [%s] ended on %s" % (last_item, socket.gethostname())
+                self.send('/queue/'+success_queue, json.dumps(self.data))
+        return timing
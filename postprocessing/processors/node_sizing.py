@@ -0,0 +1,178 @@
+"""
+    Determine how many chunks a data file should be split into
+    when running a reduction on the cluster.
+
+    The number of events is read from the metadata of the event
+    file, without reading the events themselves. Mantid's
+    DetermineChunking is only used if that fails. Results are
+    cached by file path, size and modification time.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import json
+import logging
+import threading
+
+## Memory used per event, as assumed by Mantid's DetermineChunking
+BYTES_PER_EVENT = 48.
+BYTES_TO_GIB = 1.0 / 1024.0 / 1024.0 / 1024.0
+
+## Maximum number of entries kept in the cache file
+MAX_CACHE_ENTRIES = 1000
+
+
+def count_events(filename):
+    """
+        Returns the number of events in an event NeXus file, using only
+        the file metadata. Returns None if it can't be determined.
+        @param filename: path of the event file
+    """
+    try:
+        import h5py
+    except ImportError:
+        return None
+
+    total_events = 0
+    with h5py.File(filename, 'r') as handle:
+        for entry_name, entry in handle.items():
+            if entry_name == 'entry-VETO' or not isinstance(entry, h5py.Group):
+                continue
+            n_events = 0
+            found_banks = False
+            for group in entry.values():
+                # The size of the event arrays is in the metadata
+                if isinstance(group, h5py.Group) and group.attrs.get('NX_class', '') in ['NXevent_data', b'NXevent_data'] \
+                    and 'event_id' in group:
+                    found_banks = True
+                    n_events += group['event_id'].shape[0]
+            if not found_banks:
+                if 'total_counts' not in entry:
+                    return None
+                n_events = int(entry['total_counts'][()].flatten()[0])
+            total_events += n_events
+    return total_events
+
+def estimate_chunks(filename, max_chunk_size):
+    """
+        Returns the number of chunks needed to process a file,
+        following the same logic as DetermineChunking.
+        Returns None if the number of events can't be determined.
+        @param filename: path of the event file
+        @param max_chunk_size: maximum chunk size, in GiB
+    """
+    n_events = count_events(filename)
+    if n_events is None:
+        return None
+    file_size = n_events * BYTES_PER_EVENT * BYTES_TO_GIB
+    if max_chunk_size <= 0 or file_size < max_chunk_size:
+        return 1
+    return int(file_size / max_chunk_size) + 1
+
+def determine_chunks_mantid(filename, max_chunk_size):
+    """
+        Returns the number of chunks using Mantid's DetermineChunking
+        @param filename: path of the event file
+        @param max_chunk_size: maximum chunk size, in GiB
+    """
+    import mantid.simpleapi as api
+    chunks = api.DetermineChunking(Filename=filename,
+                                   MaxChunkSize=max_chunk_size)
+    return max(chunks.rowCount(), 1)
+
+
+class NodeSizingCache(object):
+    """
+        Number of chunks for each data file, kept in a JSON file
+    """
+    def __init__(self, cache_file=None):
+        """
+            @param cache_file: path of the cache file, or None to keep the cache in memory
+        """
+        self.cache_file = cache_file
+        self._entries = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(filename, max_chunk_size):
+        """
+            Cache key for a file in its current state
+            @param filename: path of the event file
+            @param max_chunk_size: maximum chunk size, in GiB
+        """
+        stat = os.stat(filename)
+        return "%s:%s:%s:%s" % (os.path.abspath(filename), stat.st_size,
+                                int(stat.st_mtime), max_chunk_size)
+
+    def _load(self):
+        """
+            Read the cache file
+        """
+        if self._entries is None:
+            self._entries = {}
+            if self.cache_file is not None and os.path.isfile(self.cache_file):
+                try:
+                    with open(self.cache_file, 'r') as fd:
+                        self._entries = json.load(fd)
+                except:
+                    logging.error("Could not read node sizing cache %s: %s" % (self.cache_file, sys.exc_value))
+        return self._entries
+
+    def _save(self):
+        """
+            Write the cache file
+        """
+        if self.cache_file is None:
+            return
+        try:
+            tmp_file = "%s.%s" % (self.cache_file, os.getpid())
+            with open(tmp_file, 'w') as fd:
+                json.dump(self._entries, fd)
+            os.rename(tmp_file, self.cache_file)
+        except:
+            logging.error("Could not write node sizing cache %s: %s" % (self.cache_file, sys.exc_value))
+
+    def get_chunks(self, filename, max_chunk_size):
+        """
+            Returns the number of chunks needed to process a file
+            @param filename: path of the event file
+            @param max_chunk_size: maximum chunk size, in GiB
+        """
+        key = self._key(filename, max_chunk_size)
+        with self._lock:
+            entries = self._load()
+            if key in entries:
+                return entries[key]
+
+        chunks = None
+        try:
+            chunks = estimate_chunks(filename, max_chunk_size)
+        except:
+            logging.error("Could not estimate number of events in %s: %s" % (filename, sys.exc_value))
+        if chunks is None:
+            logging.info("Using DetermineChunking for %s" % filename)
+            chunks = determine_chunks_mantid(filename, max_chunk_size)
+
+        with self._lock:
+            entries = self._load()
+            if len(entries) >= MAX_CACHE_ENTRIES:
+                entries.clear()
+            entries[key] = chunks
+            self._save()
+        return chunks
+
+_cache = None
+
+def get_node_sizing_cache(configuration):
+    """
+        Returns the node sizing cache for this process
+        @param configuration: configuration object
+    """
+    global _cache
+    if _cache is None:
+        cache_file = configuration.node_sizing_cache
+        if len(cache_file.strip()) == 0:
+            cache_file = None
+        _cache = NodeSizingCache(cache_file)
+    return _cache
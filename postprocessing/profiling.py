@@ -0,0 +1,149 @@
+"""
+    Start-up profiling.
+
+    Profiling is turned on by setting the POSTPROCESSING_PROFILE environment
+    variable, or by setting "profile" to 1 in the configuration. Each event
+    is written to the log as a JSON record, for instance:
+
+        PROFILE {"event": "import", "name": "twisted", "duration": 0.21, "since_start": 0.35, "pid": 1234}
+
+    Events recorded before logging is configured are kept and written
+    once the configuration has been read. The import times of the main
+    dependencies can only be measured when using the environment variable,
+    since they are imported before the configuration is read.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import json
+import time
+import logging
+import contextlib
+
+## Environment variable used to turn on profiling
+PROFILE_ENV = 'POSTPROCESSING_PROFILE'
+## Top-level modules whose import time is recorded
+WATCHED_MODULES = ['twisted', 'stompest', 'requests', 'suds', 'nxs', 'h5py', 'numpy', 'mantid']
+## Prefix of the log records
+RECORD_PREFIX = 'PROFILE'
+## Maximum number of events kept until logging is configured
+MAX_PENDING = 1000
+
+_enabled = os.environ.get(PROFILE_ENV, '') not in ['', '0']
+# Events recorded until we know whether profiling is on and logging is configured
+_pending = []
+_flushed = False
+_original_import = None
+_import_depth = [0]
+
+
+def process_start_time():
+    """
+        Returns the time at which this process started, or the time
+        this module was imported if it cannot be determined
+    """
+    try:
+        with open('/proc/self/stat', 'r') as fd:
+            # The command name may contain spaces, so skip past it
+            fields = fd.read().rsplit(')', 1)[1].split()
+        start_since_boot = float(fields[19]) / os.sysconf('SC_CLK_TCK')
+        with open('/proc/uptime', 'r') as fd:
+            uptime = float(fd.read().split()[0])
+        return time.time() - (uptime - start_since_boot)
+    except:
+        pass
+    return _import_time
+
+_import_time = time.time()
+_start_time = process_start_time()
+
+
+def is_enabled():
+    """
+        Returns True if profiling is turned on
+    """
+    return _enabled
+
+def since_start():
+    """
+        Returns the time since this process started, in seconds
+    """
+    return time.time() - _start_time
+
+def record(event, duration=None, **fields):
+    """
+        Record a profiling event
+        @param event: type of event, like import, config, connect or first_message
+        @param duration: duration of the event, in seconds
+        @param fields: other information to include in the record
+    """
+    if _flushed and not _enabled:
+        return
+    fields['event'] = event
+    if duration is not None:
+        fields['duration'] = round(duration, 6)
+    fields['since_start'] = round(since_start(), 6)
+    fields['pid'] = os.getpid()
+    if _flushed:
+        logging.info("%s %s" % (RECORD_PREFIX, json.dumps(fields, sort_keys=True)))
+    elif len(_pending) < MAX_PENDING:
+        _pending.append(fields)
+
+@contextlib.contextmanager
+def timer(event, **fields):
+    """
+        Context manager recording the time spent in a block
+        @param event: type of event
+        @param fields: other information to include in the record
+    """
+    t_0 = time.time()
+    try:
+        yield
+    finally:
+        record(event, time.time() - t_0, **fields)
+
+def configure(configuration=None):
+    """
+        Turn on profiling if requested in the configuration, and write
+        the events recorded so far. Should be called once logging is configured.
+        @param configuration: configuration object
+    """
+    global _enabled, _flushed
+    if configuration is not None and getattr(configuration, 'profile', False):
+        _enabled = True
+    _flushed = True
+    if _enabled:
+        for fields in _pending:
+            logging.info("%s %s" % (RECORD_PREFIX, json.dumps(fields, sort_keys=True)))
+    del _pending[:]
+
+def _timed_import(name, *args, **kwargs):
+    """
+        Replacement for __import__ that records the time needed to
+        import the watched modules for the first time
+    """
+    top_level = name.split('.')[0]
+    if _import_depth[0] > 0 or top_level not in WATCHED_MODULES or top_level in sys.modules:
+        return _original_import(name, *args, **kwargs)
+    _import_depth[0] += 1
+    t_0 = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        _import_depth[0] -= 1
+        record('import', time.time() - t_0, name=top_level)
+
+def install_import_timer():
+    """
+        Record the import time of the watched modules. Only done when
+        profiling is turned on through the environment.
+    """
+    global _original_import
+    if not _enabled or _original_import is not None:
+        return
+    import __builtin__
+    _original_import = __builtin__.__import__
+    __builtin__.__import__ = _timed_import
+
+install_import_timer()
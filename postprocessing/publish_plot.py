@@ -5,11 +5,9 @@
 from __future__ import print_function
 import sys
 import logging
-from postprocessing.Configuration import Configuration, CONFIG_FILE
+from postprocessing.Configuration import get_configuration, CONFIG_FILE
+from postprocessing.web_monitor import get_session
 import string
-import requests
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 def get_user(config_file=None):
     """
@@ -17,7 +15,7 @@ def get_user(config_file=None):
     """
     if config_file is None:
         config_file = CONFIG_FILE
-    config = Configuration(config_file)
+    config = get_configuration(config_file)
     return {'username': config.publisher_username,
             'password': config.publisher_password}
 
@@ -27,14 +25,15 @@ def publish_plot(instrument, run_number, files, config_file=None):
     """
     if config_file is None:
         config_file = CONFIG_FILE
-    config = Configuration(config_file)
+    config = get_configuration(config_file)
 
     url_template = string.Template(config.publish_url)
     url = url_template.substitute(instrument=instrument,
                                   run_number=str(run_number))
-    request = requests.post(url, data={'username': config.publisher_username,
-                                       'password': config.publisher_password},
-                            files=files, verify=False)
+    # The configuration and the connection are re-used for each plot
+    request = get_session().post(url, data={'username': config.publisher_username,
+                                            'password': config.publisher_password},
+                                 files=files, verify=False)
 
     status_code = request.status_code
     if status_code != 200:
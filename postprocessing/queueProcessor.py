@@ -6,6 +6,8 @@
 """
 import logging
 import postprocessing
+# Imported first so that the import of the dependencies can be timed
+import postprocessing.profiling as profiling
 # The configuration includes setting up logging, which should be done first
 from postprocessing.Configuration import read_configuration
 configuration = read_configuration()
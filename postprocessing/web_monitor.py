@@ -0,0 +1,145 @@
+"""
+    Upload of reduced images and plot data to the web monitor.
+
+    Files are posted by a small pool of threads sharing a keep-alive
+    HTTP session, so that the uploads don't each open a new connection
+    and can run while the reduced data is being cataloged.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+## Extensions of the files sent to the web monitor
+UPLOAD_EXTENSIONS = ['png', 'jpg']
+## End of the names of plot data files sent to the web monitor
+UPLOAD_SUFFIXES = ['plot_data.dat', 'plot_data.json']
+## HTTP status codes for which an upload is retried
+RETRY_STATUS = [500, 502, 503, 504]
+
+
+def is_uploadable(filepath):
+    """
+        Returns True if a file should be sent to the web monitor
+        @param filepath: path of the file
+    """
+    extension = os.path.splitext(filepath)[1][len(os.extsep):]
+    if extension in UPLOAD_EXTENSIONS:
+        return True
+    for suffix in UPLOAD_SUFFIXES:
+        if filepath.endswith(suffix):
+            return True
+    return False
+
+def _make_retry(retries):
+    """
+        Returns the retry policy for uploads, retrying POST requests
+        on connection errors and server errors
+        @param retries: maximum number of retries
+    """
+    options = dict(total=retries, backoff_factor=0.5, status_forcelist=RETRY_STATUS)
+    try:
+        return Retry(allowed_methods=frozenset(['POST']), **options)
+    except TypeError:
+        # Older versions of urllib3
+        return Retry(method_whitelist=frozenset(['POST']), **options)
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=4, retries=3):
+    """
+        Returns the HTTP session of this process, creating it if needed
+        @param pool_size: number of connections kept open per host
+        @param retries: maximum number of retries for each request
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                  max_retries=_make_retry(retries))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.verify = False
+            _session = session
+        return _session
+
+
+class WebMonitorUploader(object):
+    """
+        Post files to the web monitor in the background
+    """
+    def __init__(self, url, credentials, max_size, threads=4, retries=3, timeout=60):
+        """
+            @param url: URL to post the files to
+            @param credentials: dictionary with the username and password
+            @param max_size: size above which a file is not sent, in bytes
+            @param threads: maximum number of concurrent uploads
+            @param retries: maximum number of retries for each file
+            @param timeout: timeout of each request, in seconds
+        """
+        self.url = url
+        self.credentials = credentials
+        self.max_size = max_size
+        self.threads = threads
+        self.timeout = timeout
+        self._session = get_session(threads, retries)
+        self._pool = None
+        self._result = None
+
+    def upload_file(self, filepath):
+        """
+            Post a single file. Returns (file path, status code or None, duration)
+            @param filepath: path of the file
+        """
+        t_0 = time.time()
+        status_code = None
+        try:
+            with open(filepath, 'rb') as fd:
+                response = self._session.post(self.url, data=self.credentials,
+                                              files={'file': fd}, timeout=self.timeout)
+            status_code = response.status_code
+            response.close()
+            logging.info("Submitted %s [status: %s] [%g sec]" % (filepath, status_code, time.time() - t_0))
+        except:
+            logging.error("Could not submit %s: %s" % (filepath, sys.exc_value))
+        return (filepath, status_code, time.time() - t_0)
+
+    def start(self, records):
+        """
+            Start sending the files that should go to the web monitor
+            @param records: list of FileRecord for the reduced files
+        """
+        to_upload = [r.path for r in records
+                     if is_uploadable(r.path) and r.size < self.max_size]
+        if len(to_upload) == 0:
+            return
+        self._pool = ThreadPool(min(self.threads, len(to_upload)))
+        self._result = self._pool.map_async(self.upload_file, to_upload)
+        self._pool.close()
+
+    def wait(self):
+        """
+            Wait for the uploads to finish. Returns the list of
+            (file path, status code or None, duration)
+        """
+        if self._pool is None:
+            return []
+        t_0 = time.time()
+        results = self._result.get()
+        self._pool.join()
+        self._pool = None
+        n_failed = len([r for r in results if r[1] != 200])
+        logging.info("Web monitor: %s files submitted, %s failed, waited %g sec" % (len(results), n_failed,
+                                                                                   time.time() - t_0))
+        return results
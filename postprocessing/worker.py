@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+    Long-lived post-processing worker.
+
+    A worker is started by the WorkerPool of the consumer. It imports the
+    post-processing code and the registered processors once, then reads
+    tasks from its standard input, one JSON object per line:
+
+        {"queue": "/queue/REDUCTION.DATA_READY", "data": {...}}
+
+    When a task is done, a JSON status line is written back to the consumer:
+
+        {"pid": 1234, "tasks": 3, "status": 0, "recycle": false}
+
+    The worker exits after a configured number of tasks, or once its
+    memory usage exceeds a configured ceiling, so that the pool can
+    replace it with a fresh process.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import json
+import logging
+import select
+import resource
+
+
+def memory_usage():
+    """
+        Returns the peak resident memory of this process, in MB
+    """
+    # ru_maxrss is given in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_worker(configuration, channel_in, channel_out):
+    """
+        Process tasks until told to stop or until we need recycling
+        @param configuration: configuration object
+        @param channel_in: file object to read tasks from
+        @param channel_out: file object to write task status to
+    """
+    from PostProcessAdmin import process_message
+    from amq_producer import get_producer, close_producer
+    from icat_client import close_session_pool, dataset_batch_time_left, flush_dataset_batch
+    from file_index import keep_indices
+    import profiling
+
+    # Workers see many runs of the same proposals, so file indices are worth keeping
+    keep_indices()
+
+    n_tasks = 0
+    while True:
+        # While ICAT datasets are waiting to be written, only wait for
+        # the next task until the batch is due.
+        time_left = dataset_batch_time_left()
+        if time_left is not None:
+            ready, _, _ = select.select([channel_in], [], [], time_left)
+            if len(ready) == 0:
+                try:
+                    flush_dataset_batch()
+                    # Send the catalog status of the datasets that were just created
+                    get_producer(configuration).flush()
+                except:
+                    logging.error("Worker %s: could not catalog datasets: %s" % (os.getpid(), sys.exc_value))
+                continue
+        line = channel_in.readline()
+        # An empty read means the consumer closed the pipe
+        if len(line) == 0:
+            break
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        if n_tasks == 0:
+            profiling.record('first_message')
+        status = 0
+        try:
+            task = json.loads(line)
+            process_message(str(task['queue']), task['data'], configuration)
+        except:
+            status = 1
+            logging.error("Worker %s: %s" % (os.getpid(), sys.exc_value))
+        n_tasks += 1
+
+        # In batch mode, send the messages for this task now that it is done
+        try:
+            get_producer(configuration).flush()
+        except:
+            status = 1
+            logging.error("Worker %s: could not send messages: %s" % (os.getpid(), sys.exc_value))
+
+        recycle = n_tasks >= configuration.worker_max_tasks \
+            or memory_usage() > configuration.worker_max_memory
+        channel_out.write(json.dumps({"pid": os.getpid(), "tasks": n_tasks,
+                                      "status": status, "recycle": recycle}) + "\n")
+        channel_out.flush()
+        if recycle:
+            logging.info("Worker %s recycled after %s tasks [%g MB]" % (os.getpid(), n_tasks, memory_usage()))
+            break
+
+    # Send pending messages and close our connections
+    close_session_pool()
+    close_producer()
+
+if __name__ == "__main__":
+    import argparse
+    from Configuration import read_configuration
+    parser = argparse.ArgumentParser(description='Post-processing worker')
+    parser.add_argument('-c', metavar='config', help='Configuration file', dest='config')
+    namespace = parser.parse_args()
+
+    # Keep the original stdout as our channel to the consumer and send
+    # anything else written to stdout, including from child processes, to stderr.
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    try:
+        if namespace.config is not None:
+            configuration = read_configuration(namespace.config)
+        else:
+            configuration = read_configuration()
+        logging.info("Worker %s started" % os.getpid())
+        run_worker(configuration, sys.stdin, channel)
+    except:
+        logging.error("Worker %s: %s" % (os.getpid(), sys.exc_value))
@@ -0,0 +1,225 @@
+"""
+    Pool of long-lived worker processes.
+
+    Instead of starting a new interpreter for every incoming message,
+    the consumer hands tasks to workers that have already imported the
+    post-processing code (see worker.py). Tasks are sent over the
+    standard input of the worker, and the worker reports back on its
+    standard output when it is done.
+
+    Workers are started with reactor.spawnProcess so that their output
+    and their termination are handled by the Twisted reactor without
+    ever blocking it. They are started through the worker start script,
+    which sets up the same environment as the task start script.
+    A worker that is recycled or that dies while working is replaced
+    right away, so that the pool stays warm.
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import json
+import logging
+from twisted.internet import reactor, protocol
+from twisted.python.procutils import which
+
+
+def find_executable(executable):
+    """
+        Returns the full path of an executable, looking it up
+        in the PATH if needed, since spawnProcess requires a path.
+        @param executable: name or path of the executable
+    """
+    if os.path.dirname(executable):
+        return executable
+    found = which(executable)
+    if len(found) == 0:
+        raise RuntimeError("Could not find executable: %s" % executable)
+    return found[0]
+
+
+class WorkerTask(object):
+    """
+        Handle for a task running on a worker
+    """
+    def __init__(self, worker, callback=None):
+        """
+            @param worker: WorkerProtocol object running the task
+            @param callback: function called with this task when it finishes
+        """
+        self.worker = worker
+        self.pid = worker.pid
+        self.returncode = None
+        self._callback = callback
+
+    def finished(self, returncode):
+        """
+            Record the status of the task and notify the consumer
+            @param returncode: status of the task, zero for success
+        """
+        self.returncode = returncode
+        if self._callback is not None:
+            self._callback(self)
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """
+        Communication with a single worker process
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.pid = None
+        self.task = None
+        self.n_tasks = 0
+        self._buffer = ''
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+
+    def outReceived(self, data):
+        """
+            Status lines from the worker
+        """
+        self._buffer += data
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            if len(line.strip()) > 0:
+                self.pool.status_received(self, line)
+
+    def processEnded(self, reason):
+        self.pool.worker_ended(self, reason.value.exitCode)
+
+    def submit(self, task, destination, data):
+        """
+            Send a task to the worker
+            @param task: WorkerTask handle
+            @param destination: queue the message was received on
+            @param data: data dictionary
+        """
+        self.task = task
+        self.transport.write(json.dumps({"queue": destination, "data": data}) + "\n")
+
+    def stop(self):
+        """
+            Ask the worker to exit once its current task is done
+        """
+        try:
+            self.transport.closeStdin()
+        except:
+            logging.error("Could not stop worker %s: %s" % (self.pid, sys.exc_value))
+
+
+class WorkerPool(object):
+    """
+        Pool of pre-started workers
+    """
+    def __init__(self, config):
+        self.config = config
+        self.executable = find_executable(config.worker_start_script)
+        self.args = [self.executable,
+                     os.path.join(config.python_dir, config.worker_script),
+                     '-c', config.config_file]
+        self.workers = []
+        # Number of workers to keep running
+        self.size = 0
+
+    def start(self, n_workers=None):
+        """
+            Pre-start workers so that they are warm when messages arrive
+            @param n_workers: number of workers to start [default: max_procs+1]
+        """
+        if n_workers is None:
+            # The consumer admits up to max_procs+1 messages at once
+            n_workers = self.config.max_procs + 1
+        self.size = n_workers
+        while len(self.workers) < n_workers:
+            self._start_worker()
+        logging.info("Worker pool started: %s workers" % len(self.workers))
+
+    def _start_worker(self):
+        """
+            Start a new worker process
+        """
+        worker = WorkerProtocol(self)
+        # The worker's stderr goes straight to ours
+        reactor.spawnProcess(worker, self.executable, self.args,
+                             env=os.environ, childFDs={0: 'w', 1: 'r', 2: 2})
+        self.workers.append(worker)
+        logging.debug("Started worker %s" % worker.pid)
+        return worker
+
+    def submit(self, destination, data, callback=None):
+        """
+            Send a task to an idle worker, starting one if needed
+            @param destination: queue the message was received on
+            @param data: data dictionary
+            @param callback: function called with the task when it finishes
+        """
+        worker = None
+        for item in self.workers:
+            if item.task is None:
+                worker = item
+                break
+        if worker is None:
+            worker = self._start_worker()
+        task = WorkerTask(worker, callback)
+        worker.submit(task, destination, data)
+        return task
+
+    def status_received(self, worker, line):
+        """
+            Process a status line sent by a worker when it finishes a task
+            @param worker: WorkerProtocol object
+            @param line: status line
+        """
+        try:
+            status = json.loads(line)
+        except:
+            logging.error("Unexpected output from worker %s: %s" % (worker.pid, line))
+            return
+        task = worker.task
+        worker.task = None
+        worker.n_tasks = status.get("tasks", worker.n_tasks + 1)
+        if status.get("recycle", False):
+            # The worker exits on its own, stop handing it tasks
+            self._retire(worker, replace=True)
+        if task is not None:
+            task.finished(status.get("status", 0))
+
+    def worker_ended(self, worker, exit_code):
+        """
+            Clean up after a worker process exited
+            @param worker: WorkerProtocol object
+            @param exit_code: exit code of the process
+        """
+        # A worker that never got a task probably can't start: don't keep starting new ones
+        self._retire(worker, replace=worker.n_tasks > 0 or worker.task is not None)
+        if worker.task is not None:
+            logging.error("Worker %s exited while processing a task" % worker.pid)
+            task = worker.task
+            worker.task = None
+            task.finished(exit_code if exit_code else 1)
+
+    def _retire(self, worker, replace=False):
+        """
+            Remove a worker from the pool
+            @param worker: WorkerProtocol object
+            @param replace: if True, start a new worker to take its place
+        """
+        if worker in self.workers:
+            self.workers.remove(worker)
+            worker.stop()
+            logging.debug("Retired worker %s after %s tasks" % (worker.pid, worker.n_tasks))
+            if replace and len(self.workers) < self.size:
+                try:
+                    self._start_worker()
+                except:
+                    logging.error("Could not replace worker %s: %s" % (worker.pid, sys.exc_value))
+
+    def shutdown(self):
+        """
+            Stop all workers
+        """
+        self.size = 0
+        for worker in list(self.workers):
+            self._retire(worker)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import glob
+import os
+import numpy
+
+__version__ = "0.0.1"
+
+GROUPS = ["instrument", "proposal", "host"]
+
+
+def latestRuns(runs):
+    # ar-report writes one file per report, so a run may be in several
+    # files: keep the record from the latest report
+    keys = numpy.char.add(numpy.char.add(runs[str('proposal')], b'/'),
+                          runs[str('runID')])
+    order = numpy.lexsort((runs[str('reported')], keys))
+    keys = keys[order]
+    last = numpy.append(keys[1:] != keys[:-1], True)
+    return runs[order][last]
+
+
+def loadRuns(paths):
+    # merge the runs of all the *-runs.npz files written by ar-report
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path,
+                                                           "*-runs.npz"))))
+        else:
+            filenames.append(path)
+
+    runs = []
+    for filename in filenames:
+        with numpy.load(filename) as content:
+            runs.append(content['runs'])
+    if len(runs) <= 0:
+        return None
+    return latestRuns(numpy.concatenate(runs))
+
+
+def percentile(values, fraction):
+    values = values[numpy.isfinite(values)]
+    if len(values) <= 0:
+        return float('nan')
+    return numpy.percentile(values, 100. * fraction)
+
+
+def toText(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'replace')
+    return str(value)
+
+
+def summarize(runs, group):
+    # vectorized statistics of the runs, one row per value of the group
+    reduced = runs[str('numReduced')] > 0
+    delay = runs[str('logCTime')] - runs[str('runStop')]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        loadShare = runs[str('loadSecTotal')] / runs[str('algoSecTotal')]
+    algoSec = runs[str('algoSecTotal')]
+
+    (names, inverse, counts) = numpy.unique(runs[str(group)],
+                                            return_inverse=True,
+                                            return_counts=True)
+    numReduced = numpy.bincount(inverse, weights=reduced,
+                                minlength=len(names))
+    # load share weighted by the algorithm time of each run
+    timed = reduced & numpy.isfinite(loadShare) & (algoSec > 0.)
+    loadSec = numpy.bincount(inverse[timed],
+                             weights=runs[str('loadSecTotal')][timed],
+                             minlength=len(names))
+    totalSec = numpy.bincount(inverse[timed], weights=algoSec[timed],
+                              minlength=len(names))
+
+    rows = []
+    for (i, name) in enumerate(names):
+        selected = (inverse == i) & reduced
+        share = loadSec[i] / totalSec[i] if totalSec[i] > 0. \
+            else float('nan')
+        rows.append((toText(name), counts[i], numReduced[i] / counts[i],
+                     percentile(delay[selected], .5),
+                     percentile(delay[selected], .95), share))
+    return rows
+
+
+def printRows(group, rows):
+    print("%-20s %6s %8s %12s %12s %10s" % (group, "runs", "reduced",
+                                            "delay50[s]", "delay95[s]",
+                                            "loadShare"))
+    for row in rows:
+        print("%-20s %6d %8.3f %12.1f %12.1f %10.3f" % row)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Aggregate statistics of '
+                                     + 'auto-reduction over the runs '
+                                     + 'written by ar-report.py --columnar')
+    parser.add_argument('paths', metavar="PATH", nargs='+',
+                        help="*-runs.npz files, or directories "
+                        + "containing them")
+    parser.add_argument('--by', choices=GROUPS, default="instrument",
+                        help="group the statistics by this column "
+                        + "[default: instrument]")
+    parser.add_argument('--instrument', default=None,
+                        help="only use the runs of this instrument")
+    parser.add_argument('--proposal', default=None,
+                        help="only use the runs of this proposal")
+    args = parser.parse_args()
+
+    runs = loadRuns(args.paths)
+    if runs is None:
+        parser.error("no runs found in %s" % " ".join(args.paths))
+    for name in ["instrument", "proposal"]:
+        value = getattr(args, name)
+        if value is not None:
+            runs = runs[runs[str(name)] == value.encode('ascii')]
+
+    print("%d runs" % len(runs))
+    printRows(args.by, summarize(runs, args.by))
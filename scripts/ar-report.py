@@ -3,21 +3,48 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import h5py
 import os
+import bisect
+import calendar
 import datetime
+import glob
+import json
+import time
+import multiprocessing
 
-__version__ = "0.0.1"
+__version__ = "0.0.4"
 
 REDUCTION_LOG = 'reduction_log'
 THE_FUTURE = "2300-01-01T00:00"
 
-shareddirlist = []
-reduceloglist = []
+
+def isoToEpoch(text):
+    # times like 2016-01-01T10:00:00.123456-05:00 to seconds since the
+    # epoch, None if unknown; times without an offset are local times
+    text = text.strip().replace(' ', 'T', 1)
+    offset = None
+    if text.endswith('Z'):
+        (text, offset) = (text[:-1], 0)
+    elif len(text) > 6 and text[-6] in '+-' and text[-3] == ':':
+        offset = int(text[-5:-3]) * 3600 + int(text[-2:]) * 60
+        if text[-6] == '-':
+            offset = -offset
+        text = text[:-6]
+    (text, _, fraction) = text.partition('.')
+    try:
+        value = datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S")
+        fraction = float('0.' + fraction) if len(fraction) > 0 else 0.
+    except ValueError:
+        return None
+    if offset is None:
+        return time.mktime(value.timetuple()) + fraction
+    return calendar.timegm(value.timetuple()) - offset + fraction
 
 
 class GenericFile(object):
     def __init__(self, path):
         self.filename = path
         self.timeCreation = None
+        self.ctime = None
         self.filesize = 0
 
         if self.filename is None:
@@ -26,6 +53,7 @@ class GenericFile(object):
             return
 
         stat = os.stat(self.filename)
+        self.ctime = stat.st_ctime
         self.timeCreation = datetime.datetime.fromtimestamp(stat.st_ctime)
         self.filesize = stat.st_size
 
@@ -66,6 +94,33 @@ class GenericFile(object):
         return "%.1fGiB" % (filesize_converted)
 
 
+class PrefixIndex(object):
+    # sorted file names, to find the names starting with a prefix
+    # without going through the whole list
+    def __init__(self, names):
+        self.names = sorted(names)
+
+    def startingWith(self, prefix):
+        start = bisect.bisect_left(self.names, prefix)
+        end = start
+        while end < len(self.names) and self.names[end].startswith(prefix):
+            end += 1
+        return self.names[start:end]
+
+
+class ReductionDirectory(object):
+    # listing of the reduction output directory and of its log directory,
+    # made once and shared by all the runs of a report
+    def __init__(self, direc):
+        self.direc = direc
+        self.logdir = os.path.join(direc, REDUCTION_LOG)
+        self.outputs = PrefixIndex(os.listdir(direc))
+        if os.path.isdir(self.logdir):
+            self.logs = PrefixIndex(os.listdir(self.logdir))
+        else:
+            self.logs = PrefixIndex([])
+
+
 class ReductionLogFile(GenericFile):
     def __init__(self, logfullname, eventfilename):
         super(ReductionLogFile, self).__init__(logfullname)
@@ -76,20 +131,16 @@ class ReductionLogFile(GenericFile):
         self.loadEventNexusDuration = 0.
         self.started = ''
         self.host = ''
-        self.loadEventNexusDuration = 0.
+        # algorithm name -> [count, total seconds, longest seconds]
+        self.algorithms = {}
 
         if not bool(self):  # something wrong with the log
             return
 
-        self.__findMantidVersion()
+        self.__parse(eventfilename)
 
-        self.__findLongestDuration()
         self.longestDuration = "%.1f" % self.longestDuration
-
-        self.__findLoadNexusTotal(eventfilename)
         self.loadEventNexusDuration = "%.1f" % self.loadEventNexusDuration
-
-        self.__findLoadTotal()
         self.loadDurationTotal = "%.1f" % self.loadDurationTotal
 
     def durationToHuman(duration):
@@ -102,32 +153,48 @@ class ReductionLogFile(GenericFile):
                 minutes = minutes % 60
         return "%dh%02dm%02ds" % (hours, minutes, int(seconds))
 
-    def __findLoadNexusTotal(self, eventfilename):
+    def __parse(self, eventfilename):
+        # collect all the statistics in a single read of the log
         with open(self.filename, 'r') as handle:
             lookForDuration = False
             for line in handle:
+                line = line.strip()
+                if "This is Mantid version" in line:
+                    self.mantidVersion \
+                        = line.split("This is Mantid version")[-1]
+                    self.mantidVersion = self.mantidVersion.strip().split()[0]
+                if 'running on' in line and "starting" in line:
+                    hostline = line.split('running on')[-1].strip()
+                    (self.host, self.started) = hostline.split('starting')
+
+                isDuration = self.hasLogDuration(line)
+                if isDuration:
+                    (algorithm, duration) \
+                        = self.logDurationToNameAndSeconds(line)
+
+                # the time to load the event file is on the first
+                # duration line after the Load line that names it
                 if "Load" in line and eventfilename in line:
                     lookForDuration = True
-                elif lookForDuration and self.hasLogDuration(line):
-                    (_, duration) \
-                        = self.logDurationToNameAndSeconds(line)
+                elif lookForDuration and isDuration:
                     if duration > 0.:
                         self.loadEventNexusDuration += duration
                     lookForDuration = False
 
-    def __findLoadTotal(self):
-        self.loadDurationTotal = 0.
-
-        with open(self.filename, 'r') as handle:
-            for line in handle:
-                if not self.hasLogDuration(line):
+                if not isDuration:
                     continue
-                if "Load" not in line:
-                    continue
-                line = line.strip()
-                (_, duration) \
-                    = self.logDurationToNameAndSeconds(line)
-                self.loadDurationTotal += duration
+
+                if "Load" in line:
+                    self.loadDurationTotal += duration
+
+                if duration > self.longestDuration:
+                    self.longestDuration = duration
+                    self.longestAlgorithm = algorithm
+
+                stats = self.algorithms.setdefault(algorithm, [0, 0., 0.])
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
 
     @staticmethod
     def hasLogDuration(line):
@@ -154,47 +221,29 @@ class ReductionLogFile(GenericFile):
             raise RuntimeError("Don't know how to parse duration")
         return (algorithm, duration)
 
-    def __findLongestDuration(self):
-        self.longestDuration = 0.  # in seconds
-
-        with open(self.filename, 'r') as handle:
-            for line in handle:
-                if self.hasLogDuration(line):
-                    line = line.strip()
-                    (algorithm, duration) \
-                        = self.logDurationToNameAndSeconds(line)
-
-                    if duration > self.longestDuration:
-                        self.longestDuration = duration
-                        self.longestAlgorithm = algorithm
 
-    def __findMantidVersion(self):
-        with open(self.filename, 'r') as handle:
-            for line in handle:
-                line = line.strip()
-                if "This is Mantid version" in line:
-                    self.mantidVersion \
-                        = line.split("This is Mantid version")[-1]
-                    self.mantidVersion = self.mantidVersion.strip().split()[0]
-                if 'running on' in line and "starting" in line:
-                    line = line.split('running on')[-1].strip()
-                    (self.host, self.started) = line.split('starting')
+def mergeAlgorithms(total, algorithms):
+    # add per-algorithm [count, total, longest] statistics to a running total
+    for (algorithm, stats) in algorithms.items():
+        current = total.setdefault(algorithm, [0, 0., 0.])
+        current[0] += stats[0]
+        current[1] += stats[1]
+        current[2] = max(current[2], stats[2])
+    return total
 
 
 class ARstatus:
-    def __init__(self, direc, eventfile):
+    def __init__(self, direc, eventfile, listing=None):
+        # the listing of the reduction directory can be shared between runs
+        if listing is None:
+            listing = ReductionDirectory(direc)
 
         self.eventfile = eventfile
-        self.reduxfiles = [os.path.join(direc, name)
-                           for name in shareddirlist
-                           if eventfile.isThisRun(name)]
-
-        logdir = os.path.join(direc, REDUCTION_LOG)
-        logprefix = os.path.join(logdir, eventfile.shortname)
+        self.reduxfiles = [os.path.join(listing.direc, name)
+                           for name in listing.outputs.startingWith(eventfile.prefix)]
 
-        self.logfiles = [os.path.join(logdir, filename)
-                         for filename in reduceloglist
-                         if filename.startswith(eventfile.shortname)]
+        self.logfiles = [os.path.join(listing.logdir, filename)
+                         for filename in listing.logs.startingWith(eventfile.shortname)]
         self.logfiles = [ReductionLogFile(filename, eventfile.shortname)
                          for filename in self.logfiles]
 
@@ -202,10 +251,17 @@ class ARstatus:
         self.longestAlgorithm = ''
         self.longestDuration = 0.
         for logfile in self.logfiles:
-            if logfile.longestDuration > self.longestDuration:
+            if float(logfile.longestDuration) > float(self.longestDuration):
                 self.longestAlgorithm = logfile.longestAlgorithm
                 self.longestDuration = logfile.longestDuration
 
+    @property
+    def algorithms(self):
+        total = {}
+        for logfile in self.logfiles:
+            mergeAlgorithms(total, logfile.algorithms)
+        return total
+
     @property
     def host(self):
         for logfile in self.logfiles:
@@ -253,6 +309,19 @@ class ARstatus:
         times = [logfile.iso8601() for logfile in self.logfiles]
         return self.findOldest(times)
 
+    def times(self):
+        # the times of the report as seconds since the epoch, None if
+        # unknown, rather than formatted to the minute
+        starts = [isoToEpoch(logfile.started) for logfile in self.logfiles]
+        starts = [value for value in starts if value is not None]
+        ctimes = [logfile.ctime for logfile in self.logfiles
+                  if logfile.ctime is not None]
+        return {"runStart": self.eventfile.epochStart,
+                "runStop": self.eventfile.epochStop,
+                "runCTime": self.eventfile.ctime,
+                "reduxStart": min(starts) if len(starts) > 0 else None,
+                "logCTime": min(ctimes) if len(ctimes) > 0 else None}
+
     @property
     def loadDurationTotal(self):
         total = 0.
@@ -287,17 +356,25 @@ class ARstatus:
                 self.loadDurationTotal, self.loadEventNexusDuration)
 
 
+def runPrefix(filename):
+    return filename.replace('.nxs.h5', '').replace('_event.nxs', '')
+
+
 class EventFile(GenericFile):
     def __init__(self, direc, filename):
         super(EventFile, self).__init__(os.path.join(direc, filename))
         self.shortname = filename
-        self.prefix = filename.replace('.nxs.h5', '').replace('_event.nxs', '')
+        self.prefix = runPrefix(filename)
 
         with h5py.File(self.filename, 'r') as handle:
             entry = handle.get("entry")
-            self.timeStart \
-                = entry.get("start_time").value[0].decode('utf-8')[:16]
-            self.timeStop = entry.get("end_time").value[0].decode('utf-8')[:16]
+            start = entry.get("start_time").value[0].decode('utf-8')
+            stop = entry.get("end_time").value[0].decode('utf-8')
+        self.timeStart = start[:16]
+        self.timeStop = stop[:16]
+        # full times, with their offset, for the columnar output
+        self.epochStart = isoToEpoch(start)
+        self.epochStop = isoToEpoch(stop)
 
     def __str__(self):
         return self.prefix
@@ -329,7 +406,7 @@ def getPropDir(descr):
     return fullpath
 
 
-def getRuns(propdir):
+def listRuns(propdir):
     # find the data directory
     datadirs = [os.path.join(propdir, subdir) for subdir in ['data', 'nexus']]
     datadirs = [direc for direc in datadirs if os.path.isdir(direc)]
@@ -337,12 +414,143 @@ def getRuns(propdir):
         raise RuntimeError("Expected only one data directory, found "
                            + ','.join(datadirs))
 
-    # get a list of event files in that directory
+    # get a list of event files in that directory, as (directory, name)
     files = os.listdir(datadirs[0])
     files = [name for name in files if not name.endswith("_histo.nxs")]
-    files = [EventFile(datadirs[0], name) for name in files]
+    return [(datadirs[0], name) for name in files]
+
+
+def getRuns(propdir):
+    return [EventFile(direc, name) for (direc, name) in listRuns(propdir)]
+
+
+def fileSignature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [path, -1, -1]
+    return [path, stat.st_size, stat.st_mtime]
 
-    return files
+
+def runSignature(direc, filename, listing):
+    # everything the report of a run depends on: the event file,
+    # the reduction logs and the names of the reduced files
+    logs = [fileSignature(os.path.join(listing.logdir, name))
+            for name in listing.logs.startingWith(filename)]
+    redux = listing.outputs.startingWith(runPrefix(filename))
+    return [fileSignature(os.path.join(direc, filename)), logs, redux]
+
+
+def reportRun(direc, filename, listing):
+    ar = ARstatus(listing.direc, EventFile(direc, filename), listing)
+    return {'report': [str(item) for item in ar.report()],
+            'algorithms': ar.algorithms,
+            'times': ar.times()}
+
+
+# listing of the reduction directory in a report worker process,
+# set once when the worker starts rather than sent with every run
+_workerListing = None
+
+
+def _initReportWorker(listing):
+    global _workerListing
+    _workerListing = listing
+
+
+def _reportRunInWorker(run):
+    return reportRun(run[0], run[1], _workerListing)
+
+
+class ReportCache(object):
+    # report row and algorithm statistics of each run, stored next to
+    # the csv file and only used while the files of the run are unchanged
+    def __init__(self, filename):
+        # with no file name, the cache is only kept in memory
+        self.filename = filename
+        self.entries = {}
+        if filename is None or not os.path.isfile(filename):
+            return
+        try:
+            with open(filename, 'r') as handle:
+                content = json.load(handle)
+            if content.get('version') == __version__:
+                self.entries = content['runs']
+        except (IOError, ValueError, KeyError):
+            self.entries = {}
+
+    def get(self, path, signature):
+        entry = self.entries.get(path)
+        if entry is not None and entry['signature'] == signature:
+            return entry['result']
+        return None
+
+    def set(self, path, signature, result):
+        self.entries[path] = {'signature': signature, 'result': result}
+
+    def keep(self, paths):
+        # forget the runs that are not in the list
+        paths = set(paths)
+        self.entries = dict([(path, entry)
+                             for (path, entry) in self.entries.items()
+                             if path in paths])
+
+    def save(self):
+        if self.filename is None:
+            return
+        tmpname = "%s.%d" % (self.filename, os.getpid())
+        with open(tmpname, 'w') as handle:
+            json.dump({'version': __version__, 'runs': self.entries}, handle)
+        os.rename(tmpname, self.filename)
+
+
+def makeReports(runs, reducedir, cache=None, processes=None,
+                usecache=True):
+    # returns the report row and algorithm statistics of each run, in
+    # the order of the runs, only computing the ones not in the cache,
+    # or all of them without usecache; the results go in the cache
+    if cache is None:
+        cache = ReportCache(None)
+    listing = ReductionDirectory(reducedir)
+    signatures = [runSignature(direc, name, listing)
+                  for (direc, name) in runs]
+    if usecache:
+        reports = [cache.get(os.path.join(direc, name), signature)
+                   for ((direc, name), signature) in zip(runs, signatures)]
+    else:
+        reports = [None] * len(runs)
+    todo = [i for i in range(len(runs)) if reports[i] is None]
+    print("%d of %d runs changed since the last report"
+          % (len(todo), len(runs)))
+    if len(todo) > 0:
+        args = [runs[i] for i in todo]
+        if processes == 1 or len(todo) == 1:
+            results = [reportRun(direc, name, listing)
+                       for (direc, name) in args]
+        else:
+            pool = multiprocessing.Pool(processes, _initReportWorker,
+                                        (listing,))
+            try:
+                results = pool.map(_reportRunInWorker, args, chunksize=4)
+            finally:
+                pool.close()
+                pool.join()
+        for i, result in zip(todo, results):
+            reports[i] = result
+            cache.set(os.path.join(*runs[i]), signatures[i], result)
+    return reports
+
+
+def writeAlgorithms(filename, algorithms):
+    # per-algorithm statistics, the most time consuming first
+    rows = sorted(algorithms.items(), key=lambda item: item[1][1],
+                  reverse=True)
+    with open(filename, 'w') as handle:
+        handle.write("algorithm,count,totalSec,meanSec,maxSec\n")
+        for (algorithm, (count, total, longest)) in rows:
+            handle.write("%s,%d,%.1f,%.1f,%.1f\n"
+                         % (algorithm, count, total,
+                            total / max(count, 1), longest))
 
 
 def getOutFilename(propdir):
@@ -351,6 +559,92 @@ def getOutFilename(propdir):
     return "%s-%s.csv" % (inst, prop)
 
 
+def getAlgorithmsFilename(propdir):
+    return getOutFilename(propdir).replace(".csv", "-algorithms.csv")
+
+
+# typed columns of the columnar output, one record per run, with
+# the time of the report so that ar-query keeps the latest one
+COLUMNS = [("instrument", "S16"), ("proposal", "S32"), ("runID", "S64"),
+           ("reported", "f8"),
+           ("runStart", "f8"), ("runStop", "f8"), ("runCTime", "f8"),
+           ("eventSizeMiB", "f8"), ("host", "S64"), ("numReduced", "i4"),
+           ("version", "S32"), ("reduxStart", "f8"), ("logCTime", "f8"),
+           ("longAlgo", "S64"), ("algoSec", "f8"), ("algoSecTotal", "f8"),
+           ("loadSecTotal", "f8"), ("loadNexusSecTotal", "f8")]
+
+
+def columnarDtype():
+    import numpy
+    # python 2 numpy wants native strings for field names and formats
+    return numpy.dtype([(str(name), str(fmt)) for (name, fmt) in COLUMNS])
+
+
+def toFloat(text):
+    try:
+        return float(text)
+    except ValueError:
+        return float('nan')
+
+
+def getColumnarFilename(propdir, runID=None):
+    # one file per report: the whole proposal, or a single run
+    # that was appended since
+    (parent, prop) = os.path.split(propdir)
+    (parten, inst) = os.path.split(parent)
+    if runID is None:
+        return "%s-%s-runs.npz" % (inst, prop)
+    else:
+        return "%s-%s-%s-runs.npz" % (inst, prop, runID)
+
+
+def toRecords(instrument, proposal, results, reported):
+    import numpy
+    records = numpy.zeros(len(results), dtype=columnarDtype())
+    header = ARstatus.header()
+    for (i, result) in enumerate(results):
+        row = dict(zip(header, result['report']))
+        values = {"instrument": instrument, "proposal": proposal,
+                  "reported": reported,
+                  "numReduced": int(row['numReduced']),
+                  "algoSecTotal": sum([stats[1] for stats in
+                                       result['algorithms'].values()])}
+        for name in ["runID", "host", "version", "longAlgo"]:
+            values[name] = row[name].strip()
+        for (name, value) in result['times'].items():
+            values[name] = float('nan') if value is None else value
+        for name in ["eventSizeMiB", "algoSec", "loadSecTotal",
+                     "loadNexusSecTotal"]:
+            values[name] = toFloat(row[name])
+        for (name, value) in values.items():
+            if isinstance(value, type("")):
+                value = value.encode('ascii', 'replace')
+            records[str(name)][i] = value
+    return records
+
+
+def writeColumnar(filename, records):
+    # each report has its own file, written under a temporary
+    # name and renamed so that readers never see half a file
+    import numpy
+    tmpname = "%s.%d" % (filename, os.getpid())
+    with open(tmpname, 'wb') as handle:
+        numpy.savez_compressed(handle, runs=records)
+    os.rename(tmpname, filename)
+
+
+def removeRunFiles(directory, propdir, before):
+    # single-run files of a proposal written before a full report
+    # are superseded by it
+    pattern = getColumnarFilename(propdir, "*")
+    for filename in glob.glob(os.path.join(directory, pattern)):
+        try:
+            if os.path.getmtime(filename) < before:
+                os.remove(filename)
+        except OSError:
+            pass  # removed by another report
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -362,6 +656,16 @@ if __name__ == "__main__":
     parser.add_argument('outputdir',
                         help="directory to write csv to, "
                              + "defaults to instrument shared")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of processes, defaults to the "
+                             + "number of cores")
+    parser.add_argument('--no-cache', dest='usecache', action='store_false',
+                        help="report every run again rather than use "
+                             + "the cache of previous reports")
+    parser.add_argument('--columnar', metavar="DIR", default=None,
+                        help="also write the runs to INST-PROP-runs.npz "
+                             + "in this directory, or to "
+                             + "INST-PROP-RUN-runs.npz for a single run")
     args = parser.parse_args()
 
     runfile = os.path.abspath(args.runfile)
@@ -372,17 +676,23 @@ if __name__ == "__main__":
     if runfile == propdir:
         runfile = None
 
+    # runs appended after this are not in a full report
+    reported = time.time()
     print("Finding event nexus files in '%s'" % propdir)
     if runfile is not None:
-        runs = [EventFile(*(os.path.split(runfile)))]
+        runs = [os.path.split(runfile)]
     else:
-        runs = getRuns(propdir)
+        runs = listRuns(propdir)
     reducedir = os.path.join(propdir, 'shared', 'autoreduce')
-    shareddirlist = os.listdir(reducedir)
-    reduceloglist = os.listdir(os.path.join(reducedir, REDUCTION_LOG))
 
     outfile = getOutFilename(propdir)
     outfile = os.path.join(args.outputdir, outfile)
+    cache = ReportCache(outfile + ".cache")
+    if runfile is None:
+        cache.keep([os.path.join(*run) for run in runs])
+    results = makeReports(runs, reducedir, cache, args.jobs, args.usecache)
+    cache.save()
+
     print("Writing results to '%s'" % outfile)
     total_runs = len(runs)
     total_reduced = 0
@@ -390,13 +700,35 @@ if __name__ == "__main__":
         mode = 'w'
     else:
         mode = 'a'
+    numReducedColumn = ARstatus.header().index("numReduced")
     with open(outfile, mode) as handle:
         if mode == 'w':
             handle.write(','.join(ARstatus.header()) + "\n")
-        for eventfile in runs:
-            ar = ARstatus(reducedir, eventfile)
-            report = [str(item) for item in ar.report()]
-            if len(ar.reduxfiles) > 0:
+        for result in results:
+            report = result['report']
+            if int(report[numReducedColumn]) > 0:
                 total_reduced += 1
             handle.write(','.join(report) + "\n")
     print("%d of %d files reduced" % (total_reduced, total_runs))
+
+    # algorithm statistics over all the runs reported so far
+    algorithms = {}
+    for entry in cache.entries.values():
+        mergeAlgorithms(algorithms, entry['result']['algorithms'])
+    algofile = os.path.join(args.outputdir, getAlgorithmsFilename(propdir))
+    print("Writing algorithm statistics to '%s'" % algofile)
+    writeAlgorithms(algofile, algorithms)
+
+    if args.columnar is not None:
+        (parent, proposal) = os.path.split(propdir)
+        instrument = os.path.split(parent)[1]
+        if runfile is None:
+            npzfile = getColumnarFilename(propdir)
+        else:
+            npzfile = getColumnarFilename(propdir, runPrefix(runs[0][1]))
+        npzfile = os.path.join(args.columnar, npzfile)
+        writeColumnar(npzfile, toRecords(instrument, proposal, results,
+                                         reported))
+        if runfile is None:
+            removeRunFiles(args.columnar, propdir, reported)
+        print("Wrote %d runs to '%s'" % (len(results), npzfile))
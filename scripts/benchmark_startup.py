@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+    Measure the start-up latency of the post-processing task script.
+
+    A stub STOMP broker is started on a local port, and PostProcessAdmin.py
+    is run several times in communication-only mode with profiling turned on.
+    The wall time of each run and the PROFILE records written to the log are
+    summarized as median (p50) and 95th percentile (p95).
+
+    Example:
+        python benchmark_startup.py -n 20 -c ../configuration/post_process_consumer.conf.local
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+# The postprocessing package sits next to the scripts directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from postprocessing.latency import percentile
+
+PROFILE_PREFIX = 'PROFILE '
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'postprocessing', 'PostProcessAdmin.py')
+DEFAULT_QUEUE = '/queue/CATALOG.DATA_READY'
+
+
+class StubBroker(object):
+    """
+        Minimal STOMP broker: accepts connections, acknowledges
+        receipts and counts the messages it receives
+    """
+    def __init__(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            connection, _ = self._server.accept()
+            thread = threading.Thread(target=self._handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def _reply(connection, command, headers):
+        lines = [command] + ["%s:%s" % item for item in headers.items()]
+        connection.sendall(("\n".join(lines) + "\n\n\x00").encode('utf-8'))
+
+    def _handle(self, connection):
+        buf = b''
+        try:
+            while True:
+                data = connection.recv(65536)
+                if len(data) == 0:
+                    break
+                buf += data
+                while b'\x00' in buf:
+                    frame, buf = buf.split(b'\x00', 1)
+                    lines = frame.decode('utf-8', 'replace').lstrip('\r\n').split('\n')
+                    command = lines[0].strip()
+                    headers = {}
+                    for line in lines[1:]:
+                        if len(line.strip()) == 0:
+                            break
+                        key, _, value = line.partition(':')
+                        headers[key] = value
+                    if command in ['CONNECT', 'STOMP']:
+                        version = headers.get('accept-version', '1.0').split(',')[0]
+                        self._reply(connection, 'CONNECTED', {'version': version, 'session': 'stub'})
+                        continue
+                    if command == 'SEND':
+                        with self._lock:
+                            self.messages += 1
+                    if 'receipt' in headers:
+                        self._reply(connection, 'RECEIPT', {'receipt-id': headers['receipt']})
+                    if command == 'DISCONNECT':
+                        return
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+
+def write_configuration(template, work_dir, port):
+    """
+        Write a configuration for the benchmark, pointing to the stub broker
+        @param template: configuration file to start from
+        @param work_dir: directory for the configuration and log files
+        @param port: port of the stub broker
+    """
+    with open(template, 'r') as fd:
+        config = json.load(fd)
+    config['failover_uri'] = "failover:(tcp://127.0.0.1:%s)?startupMaxReconnectAttempts=0,maxReconnectAttempts=0" % port
+    config['log_file'] = os.path.join(work_dir, 'benchmark.log')
+    config['communication_only'] = 1
+    config_file = os.path.join(work_dir, 'benchmark.conf')
+    with open(config_file, 'w') as fd:
+        json.dump(config, fd)
+    return config_file, config['log_file']
+
+def read_profile_records(log_file):
+    """
+        Returns the PROFILE records found in a log file
+        @param log_file: path of the log file
+    """
+    records = []
+    if not os.path.isfile(log_file):
+        return records
+    with open(log_file, 'r') as fd:
+        for line in fd:
+            position = line.find(PROFILE_PREFIX)
+            if position >= 0:
+                try:
+                    records.append(json.loads(line[position + len(PROFILE_PREFIX):]))
+                except ValueError:
+                    pass
+    return records
+
+def summarize(wall_times, records):
+    """
+        Print the p50 and p95 of the wall time and of each profiling event
+        @param wall_times: list of wall times of the runs, in seconds
+        @param records: list of profiling records
+    """
+    rows = [("wall time", wall_times)]
+    groups = {}
+    for item in records:
+        name = item['event']
+        if 'name' in item:
+            name = "%s %s" % (name, item['name'])
+        # Durations for timed events, time since start otherwise
+        value = item['duration'] if 'duration' in item else item['since_start']
+        groups.setdefault(name, []).append(value)
+    for name in sorted(groups.keys()):
+        rows.append((name, groups[name]))
+
+    print("%-30s %6s %10s %10s" % ("event", "count", "p50 [s]", "p95 [s]"))
+    for name, values in rows:
+        print("%-30s %6d %10.4f %10.4f" % (name, len(values), percentile(values, 0.5), percentile(values, 0.95)))
+
+def run_benchmark(n_runs, template, script, python, queue):
+    """
+        Run the task script several times against a stub broker
+        @param n_runs: number of runs
+        @param template: configuration file to start from
+        @param script: path of PostProcessAdmin.py
+        @param python: python executable
+        @param queue: queue passed to the task script
+    """
+    broker = StubBroker()
+    broker.start()
+    work_dir = tempfile.mkdtemp(prefix='pp_benchmark_')
+    try:
+        config_file, log_file = write_configuration(template, work_dir, broker.port)
+        data_file = os.path.join(work_dir, 'BENCH_1_event.nxs')
+        open(data_file, 'w').close()
+        data = json.dumps({"facility": "SNS", "instrument": "BENCH", "ipts": "IPTS-0",
+                           "run_number": "1", "data_file": data_file})
+
+        env = dict(os.environ)
+        env['POSTPROCESSING_PROFILE'] = '1'
+        wall_times = []
+        for _ in range(n_runs):
+            t_0 = time.time()
+            subprocess.call([python, script, '-q', queue, '-c', config_file, '-d', data], env=env)
+            wall_times.append(time.time() - t_0)
+
+        print("%s runs, %s messages received by the stub broker" % (n_runs, broker.messages))
+        summarize(wall_times, read_profile_records(log_file))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure the start-up latency of PostProcessAdmin.py')
+    parser.add_argument('-n', metavar='runs', type=int, default=10, dest='runs',
+                        help='Number of runs [default: 10]')
+    parser.add_argument('-c', metavar='config', dest='config', required=True,
+                        help='Configuration file to start from')
+    parser.add_argument('-s', metavar='script', dest='script', default=DEFAULT_SCRIPT,
+                        help='Path of PostProcessAdmin.py')
+    parser.add_argument('-p', metavar='python', dest='python', default=sys.executable,
+                        help='Python executable used to run the script')
+    parser.add_argument('-q', metavar='queue', dest='queue', default=DEFAULT_QUEUE,
+                        help='Queue passed to the script [default: %s]' % DEFAULT_QUEUE)
+    namespace = parser.parse_args()
+    run_benchmark(namespace.runs, namespace.config, os.path.abspath(namespace.script),
+                  namespace.python, namespace.queue)
@@ -0,0 +1,6 @@
+#!/bin/bash
+# Environment of the post-processing tasks.
+# Sourced by startJob.sh and startWorker.sh so that tasks run in the same
+# environment whether or not the worker pool is used.
+module load mantid-mpi
+module load sns_software
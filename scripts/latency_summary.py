@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+    Summarize the end-to-end latency records written by the post-processing
+    agent when "latency_file" is set in its configuration.
+
+    For each instrument, the time spent between consecutive processing
+    stages is reported as median (p50), 95th percentile (p95) and maximum.
+
+    Example:
+        python latency_summary.py /opt/postprocessing/log/latency.json
+        python latency_summary.py -q /queue/REDUCTION.DATA_READY --since 24 latency.json
+
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+# The postprocessing package sits next to the scripts directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from postprocessing.latency import percentile
+
+## Intervals reported, as (name, first stage, last stage)
+INTERVALS = [("queue wait", "received", "admitted"),
+             ("dispatch", "admitted", "spawned"),
+             ("start-up", "spawned", "started"),
+             ("preparation", "started", "job_submitted"),
+             ("job", "job_submitted", "job_finished"),
+             ("finishing", "job_finished", "completed"),
+             ("processing", "started", "completed"),
+             ("total", "received", "completed")]
+
+
+def read_records(file_names, queue=None, since=None):
+    """
+        Returns the latency records found in a list of files
+        @param file_names: list of latency files
+        @param queue: if given, only keep the records for this queue
+        @param since: if given, only keep the records completed after this time
+    """
+    records = []
+    for file_name in file_names:
+        with open(file_name, 'r') as fd:
+            for line in fd:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                if queue is not None and item.get('queue') != queue:
+                    continue
+                if since is not None and item['stages'].get('completed', 0) < since:
+                    continue
+                records.append(item)
+    return records
+
+def group_intervals(records):
+    """
+        Returns the durations of each interval, by instrument
+        @param records: list of latency records
+    """
+    groups = {}
+    for item in records:
+        stages = item['stages']
+        instrument = item.get('instrument') or 'UNKNOWN'
+        intervals = groups.setdefault(instrument, {})
+        for name, first, last in INTERVALS:
+            if first in stages and last in stages:
+                intervals.setdefault(name, []).append(stages[last] - stages[first])
+    return groups
+
+def summarize(records):
+    """
+        Print the p50, p95 and maximum of each interval, by instrument
+        @param records: list of latency records
+    """
+    groups = group_intervals(records)
+    print("%-12s %-12s %6s %10s %10s %10s" % ("instrument", "interval", "count",
+                                              "p50 [s]", "p95 [s]", "max [s]"))
+    for instrument in sorted(groups.keys()):
+        for name, _, _ in INTERVALS:
+            values = groups[instrument].get(name, [])
+            if len(values) == 0:
+                continue
+            print("%-12s %-12s %6d %10.2f %10.2f %10.2f" % (instrument, name, len(values),
+                                                           percentile(values, 0.5),
+                                                           percentile(values, 0.95),
+                                                           max(values)))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize post-processing latency records')
+    parser.add_argument('files', metavar='file', nargs='+',
+                        help='Latency files written by the post-processing agent')
+    parser.add_argument('-q', metavar='queue', dest='queue', default=None,
+                        help='Only use messages received on this queue')
+    parser.add_argument('--since', metavar='hours', type=float, default=None,
+                        help='Only use messages completed in the last given hours')
+    namespace = parser.parse_args()
+
+    since = None
+    if namespace.since is not None:
+        since = time.time() - 3600.0 * namespace.since
+    records = read_records(namespace.files, namespace.queue, since)
+    if len(records) == 0:
+        print("No latency records found")
+        sys.exit(1)
+    print("%s messages" % len(records))
+    summarize(records)
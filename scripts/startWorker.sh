@@ -0,0 +1,5 @@
+#!/bin/bash
+# Usage: startWorker.sh <path to worker.py> [worker arguments]
+# Start a worker of the worker pool in the same environment as startJob.sh
+source $(dirname $0)/job_environment.sh
+exec python "$@"